@@ -0,0 +1 @@
+"""Benchmarks for hdata, runnable offline against a local mock of the HyperData API."""
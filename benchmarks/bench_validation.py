@@ -0,0 +1,39 @@
+"""Compare the vectorized and python validation engines.
+
+Run with: python -m benchmarks.bench_validation --rows 1m
+"""
+
+import argparse
+from time import perf_counter
+
+import pandas as pd
+
+from benchmarks.datasets import make_tables, parse_size
+from hdata.force_validation import validate_output
+
+
+def run(rows: int, repeat: int):
+    rows = parse_size(rows)
+    tables = make_tables(rows)
+    results = {}
+    for engine in ['python', 'vectorized']:
+        timings = []
+        for _ in range(repeat):
+            copies = [table.copy() for table in tables]
+            start = perf_counter()
+            output = validate_output(*copies, engine=engine)
+            timings.append(perf_counter() - start)
+        results[engine] = output
+        print(f"{engine:>10}: best {min(timings):.3f}s over {repeat} runs, {rows / min(timings):,.0f} rows/s")
+
+    for left, right in zip(results['python'], results['vectorized']):
+        pd.testing.assert_frame_equal(left, right)
+    print("Outputs are identical.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', default='1m')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
@@ -0,0 +1,61 @@
+"""Synthetic datasets for the benchmarks."""
+
+import uuid
+
+import numpy as np
+import pandas as pd
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+
+def parse_size(size) -> int:
+    """Row count for a size name such as '1m', or an integer"""
+
+    if isinstance(size, int):
+        return size
+    return SIZES[size.lower()] if size.lower() in SIZES else int(size)
+
+
+def make_source_frame(rows: int, attributes: int = 5, entities: int = 1000, seed: int = 0) -> pd.DataFrame:
+    """Raw source data: one row per entity and date, one column per attribute"""
+
+    rng = np.random.default_rng(seed)
+    row = np.arange(rows)
+    entities = max(1, min(entities, rows))
+    frame = pd.DataFrame({
+        'name': np.char.add('entity ', (row % entities).astype(str)),
+        'date': (pd.Timestamp('2000-01-01') + pd.to_timedelta(row // entities, unit='D')).strftime('%Y-%m-%d'),
+    })
+    for i in range(attributes):
+        frame[f"attribute_{i}"] = rng.random(rows)
+    return frame
+
+
+def make_tables(rows: int, entities: int = 1000, attributes: int = 50, seed: int = 0):
+    """Raw entity, attribute and record output tables with unique record keys"""
+
+    rng = np.random.default_rng(seed)
+    entity_uuids = np.array([str(uuid.UUID(int=int(i))) for i in rng.integers(1, 2 ** 63, entities)])
+    attribute_uuids = np.array([str(uuid.UUID(int=int(i))) for i in rng.integers(1, 2 ** 63, attributes)])
+
+    entity = pd.DataFrame({
+        'entity_uuid': entity_uuids,
+        'entity_name': [f"entity {i}" for i in range(entities)],
+        'entity_description': [''] * entities,
+    })
+    attribute = pd.DataFrame({
+        'attribute_uuid': attribute_uuids,
+        'attribute_name': [f"attribute {i}" for i in range(attributes)],
+        'attribute_description': [''] * attributes,
+    })
+
+    row = np.arange(rows)
+    pair = row % (entities * attributes)
+    dates = pd.Timestamp('2000-01-01') + pd.to_timedelta(row // (entities * attributes), unit='D')
+    record = pd.DataFrame({
+        'datetime': dates.strftime('%Y-%m-%d'),
+        'entity_uuid': entity_uuids[pair % entities],
+        'attribute_uuid': attribute_uuids[pair // entities],
+        'record_value': rng.random(rows),
+    })
+    return entity, attribute, record
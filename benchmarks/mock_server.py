@@ -0,0 +1,177 @@
+"""In-process stand-in for the HyperData API.
+
+Serves /transform, /download_output and the data_url endpoint on localhost, returning real
+parquet payloads in the same shapes as the API, with configurable latency and failures.
+The transformation is a simple melt: the 'name' column becomes the entity, every other
+column except 'date' becomes an attribute, and each cell becomes a record.
+"""
+
+import base64
+import io
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from hdata.transport import RetryPolicy, Transport
+from hdata.wire import OUTPUT_TABLES, to_parquet_bytes
+
+NAMESPACE = uuid.UUID('6f1c1b6e-2f7c-4c55-9d59-8f1f1a3b1c2d')
+
+
+def mock_transform(frame: pd.DataFrame):
+    """Turn a raw chunk into entity, attribute and record tables"""
+
+    names = frame['name'].astype(str)
+    dates = frame['date'].astype(str)
+    columns = [column for column in frame.columns if column not in ('name', 'date')]
+
+    codes, unique_names = pd.factorize(names)
+    unique_uuids = [str(uuid.uuid5(NAMESPACE, f"entity:{name}")) for name in unique_names]
+    entity = pd.DataFrame({'entity_uuid': unique_uuids, 'entity_name': unique_names, 'entity_description': ''})
+
+    attribute_uuids = [str(uuid.uuid5(NAMESPACE, f"attribute:{column}")) for column in columns]
+    attribute = pd.DataFrame({'attribute_uuid': attribute_uuids, 'attribute_name': columns,
+                              'attribute_description': ''})
+
+    entity_uuids = pd.Series(unique_uuids, dtype=object).to_numpy()[codes]
+    record = pd.concat([
+        pd.DataFrame({'datetime': dates.to_numpy(), 'entity_uuid': entity_uuids, 'attribute_uuid': attribute_uuid,
+                      'record_value': frame[column].to_numpy()})
+        for column, attribute_uuid in zip(columns, attribute_uuids)
+    ], ignore_index=True)
+    return entity, attribute, record
+
+
+class MockHyperDataServer:
+    """Local HTTP server imitating the transformation API
+
+    transform_latency and download_latency add a fixed delay to each request, and
+    failure_rate answers that fraction of /transform requests with 503 and Retry-After: 0.
+    """
+
+    def __init__(self, transform_latency: float = 0.0, download_latency: float = 0.0, failure_rate: float = 0.0,
+                 seed: int = 0):
+        self.transform_latency = transform_latency
+        self.download_latency = download_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.outputs = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def transport(self, **kwargs) -> Transport:
+        kwargs.setdefault('retry', RetryPolicy(backoff_factor=0.01))
+        return Transport(self.url, **kwargs)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _fail(self) -> bool:
+        with self._lock:
+            return self.random.random() < self.failure_rate
+
+    def transform(self, body: bytes, content_type: str) -> str:
+        if content_type.startswith('application/octet-stream'):
+            parquet = body
+        else:
+            raw = base64.b64decode(json.loads(body)['raw_data'])
+            with zipfile.ZipFile(io.BytesIO(raw)) as zipf:
+                parquet = zipf.read('source.parquet')
+        tables = mock_transform(pd.read_parquet(io.BytesIO(parquet)))
+        process_uuid = str(uuid.uuid4())
+        with self._lock:
+            self.outputs[process_uuid] = tables
+        return process_uuid
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes, so avoid Nagle delays
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                mock.requests.append(('POST', self.path))
+                if urlparse(self.path).path != '/transform':
+                    return self._send(404)
+                time.sleep(mock.transform_latency)
+                if mock._fail():
+                    return self._send(503, b'{}', headers={'Retry-After': '0'})
+                process_uuid = mock.transform(body, self.headers.get('Content-Type', ''))
+                self._send(200, json.dumps({'process_uuid': process_uuid}).encode())
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                mock.requests.append(('GET', url.path))
+                if url.path == '/download_output':
+                    time.sleep(mock.download_latency)
+                    process_uuid = parse_qs(url.query)['process_uuid'][0]
+                    return self._send(200, json.dumps({'data_url': f"{mock.url}/data/{process_uuid}"}).encode())
+                if url.path.startswith('/data/'):
+                    with mock._lock:
+                        tables = mock.outputs.pop(url.path[len('/data/'):], None)
+                    if tables is None:
+                        return self._send(404)
+                    if 'multipart/mixed' in self.headers.get('Accept', ''):
+                        return self._send_multipart(tables)
+                    body = json.dumps({name: base64.b64encode(to_parquet_bytes(table)).decode()
+                                       for name, table in zip(OUTPUT_TABLES, tables)}).encode()
+                    return self._send(200, body)
+                self._send(404)
+
+            def _send_multipart(self, tables):
+                boundary = uuid.uuid4().hex
+                body = io.BytesIO()
+                for name, table in zip(OUTPUT_TABLES, tables):
+                    body.write(f"--{boundary}\r\nContent-Disposition: attachment; name=\"{name}\"\r\n"
+                               "Content-Type: application/octet-stream\r\n\r\n".encode())
+                    body.write(to_parquet_bytes(table, compression='zstd'))
+                    body.write(b'\r\n')
+                body.write(f"--{boundary}--\r\n".encode())
+                self._send(200, body.getvalue(), f"multipart/mixed; boundary={boundary}")
+
+        return Handler
@@ -0,0 +1,74 @@
+"""End to end throughput benchmark against the local mock API.
+
+Run with: python -m benchmarks.run --rows 1m --workers 4 --wire-format binary
+"""
+
+import argparse
+import logging
+import sys
+from time import perf_counter
+
+from benchmarks.datasets import make_source_frame, parse_size
+from benchmarks.mock_server import MockHyperDataServer
+from hdata import ChunkSizer, Instrumentation, Source, transform
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB, or nan where unavailable"""
+
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run(rows, workers: int = 1, encode_workers: int = 1, wire_format: str = 'json', chunk_rows: int = 30000,
+        latency: float = 0.0, queries: int = 1000, chunk_bytes: int = None, adaptive: bool = False):
+    rows = parse_size(rows)
+    frame = make_source_frame(rows)
+    instrumentation = Instrumentation()
+
+    with MockHyperDataServer(transform_latency=latency, download_latency=latency) as server:
+        sizer = None
+        if chunk_bytes or adaptive:
+            sizer = ChunkSizer(chunk_bytes or ChunkSizer().target_bytes, adaptive=adaptive)
+        source = Source('benchmark', frame, max_rows_per_chunk=chunk_rows, encode_workers=encode_workers,
+                        chunk_sizer=sizer)
+        start = perf_counter()
+        output = transform([source], 'token', max_workers=workers, transport=server.transport(pool_maxsize=workers),
+                           wire_format=wire_format, instrumentation=instrumentation)
+        seconds = perf_counter() - start
+
+    print(f"transform: {rows:,} source rows, {len(output.record):,} records in {seconds:.2f}s "
+          f"({rows / seconds:,.0f} source rows/s), peak RSS {peak_rss_mb():,.0f} MB")
+    print(instrumentation.report())
+
+    names = output.entity['entity_name'].to_numpy()
+    attributes = output.attribute['attribute_name'].to_numpy()
+    output.query(entity=names[0])
+    start = perf_counter()
+    for i in range(queries):
+        output.query(entity=names[i % len(names)], attribute=attributes[i % len(attributes)],
+                     after_date='2000-01-01')
+    seconds = perf_counter() - start
+    print(f"query: {queries / seconds:,.0f} point queries/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', default='10k', help="row count or one of 10k, 100k, 1m, 10m")
+    parser.add_argument('--workers', type=int, default=1, help="chunks in flight")
+    parser.add_argument('--encode-workers', type=int, default=1, help="chunk encoding processes")
+    parser.add_argument('--wire-format', default='json', choices=['json', 'binary'])
+    parser.add_argument('--chunk-rows', type=int, default=30000)
+    parser.add_argument('--chunk-bytes', type=int, help="target encoded bytes per chunk instead of --chunk-rows")
+    parser.add_argument('--adaptive', action='store_true', help="tune chunk size from observed latency")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each mock API request")
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    run(args.rows, args.workers, args.encode_workers, args.wire_format, args.chunk_rows, args.latency, args.queries,
+        args.chunk_bytes, args.adaptive)
@@ -5,4 +5,7 @@ __email__ = 'judah@hyperdata.so'
 __version__ = '0.16.0'
 
 from .models import Source
-from .functions import transform
+from .functions import TransformationError, transform
+from .cache import ChunkCache
+from .instrumentation import Instrumentation
+from .chunking import ChunkSizer
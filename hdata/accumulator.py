@@ -0,0 +1,57 @@
+import pandas as pd
+import pyarrow as pa
+from typing import List, Tuple, Union
+
+Table = Union[pd.DataFrame, pa.Table]
+
+
+def concat_tables(tables: List[Table]) -> pd.DataFrame:
+    """Concatenate pandas or Arrow tables once, keeping column dtypes
+
+    Empty tables are skipped unless every table is empty, so they cannot upcast the
+    result to object columns.
+    """
+
+    if not tables:
+        return pd.DataFrame()
+
+    non_empty = [table for table in tables if table.shape[0] > 0] or tables[:1]
+    if all(isinstance(table, pa.Table) for table in non_empty):
+        return pa.concat_tables(non_empty, promote_options='default').to_pandas()
+
+    frames = [table.to_pandas() if isinstance(table, pa.Table) else table for table in non_empty]
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+class TableAccumulator:
+    """Collect the entity, attribute and record tables of each chunk and concatenate them once
+
+    Chunks may be added as pandas DataFrames or Arrow tables. Nothing is copied until
+    result is called, so the cost of adding a chunk does not grow with the number of chunks
+    already collected.
+    """
+
+    def __init__(self):
+        self.entity: List[Table] = []
+        self.attribute: List[Table] = []
+        self.record: List[Table] = []
+
+    def add(self, entity: Table, attribute: Table, record: Table):
+        self.entity.append(entity)
+        self.attribute.append(attribute)
+        self.record.append(record)
+
+    def extend(self, other: 'TableAccumulator'):
+        """Add every chunk collected by another accumulator, after the chunks already here"""
+
+        self.entity.extend(other.entity)
+        self.attribute.extend(other.attribute)
+        self.record.extend(other.record)
+
+    def __len__(self):
+        return len(self.record)
+
+    def result(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        return concat_tables(self.entity), concat_tables(self.attribute), concat_tables(self.record)
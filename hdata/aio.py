@@ -0,0 +1,369 @@
+"""asyncio counterparts of send, download, apply_transformation and transform
+
+Requests go through an AsyncTransport, which holds one httpx.AsyncClient connection pool
+that any number of jobs on the same event loop can share. Chunks in flight are bounded by
+an asyncio.Semaphore, and cancelling the task running a transformation cancels its
+in-flight requests. Reading, encoding, decoding and validation are CPU bound and run in
+worker threads so the event loop stays responsive.
+
+httpx is an optional dependency: pip install httpx
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .accumulator import TableAccumulator
+from .cache import ChunkCache
+from .chunking import ChunkSizer
+from .functions import SourceStatus, check_sources, finish_transform, lookup_chunk, store_chunk
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation, logger
+from .models import Output, Source
+from .transport import DEFAULT_BASE_URL, RetryPolicy
+from .wire import (BINARY_CONTENT_TYPE, MULTIPART_CONTENT_TYPE, OUTPUT_TABLES, JSONTableReader, MultipartReader,
+                   check_wire_format, multipart_boundary, read_parquet_bytes, zip_payload)
+
+_DONE = object()
+
+
+class AsyncTransport:
+    """Pooled asyncio HTTP transport for the HyperData API
+
+    The async counterpart of Transport: an httpx.AsyncClient keeps up to max_connections
+    keep-alive connections, and throttled (429) and server (5xx) responses and connection
+    errors are retried with the retry policy. Create it inside the event loop that uses it.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, timeout=(10, 300), retry: Optional[RetryPolicy] = None,
+                 max_connections: int = 10, client: Optional['httpx.AsyncClient'] = None):
+        if httpx is None:
+            raise ImportError("The asyncio API requires httpx. Install it with: pip install httpx")
+        self.base_url = base_url.rstrip('/')
+        self.retry = retry if retry is not None else RetryPolicy()
+        if client is None:
+            connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+            client = httpx.AsyncClient(timeout=httpx.Timeout(read, connect=connect),
+                                       limits=httpx.Limits(max_connections=max_connections,
+                                                           max_keepalive_connections=max_connections))
+        self.client = client
+        self.sleep = asyncio.sleep
+
+    def url(self, path: str) -> str:
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return self.base_url + '/' + path.lstrip('/')
+
+    async def request(self, method: str, path: str, stream: bool = False, **kwargs) -> 'httpx.Response':
+        """Send a request, retrying according to the retry policy
+
+        With stream, the body is left unread; read it with aiter_bytes or aread and close the
+        response. As with Transport, the last response is returned once retries are exhausted.
+        """
+
+        url = self.url(path)
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.send(self.client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError:
+                if attempt >= self.retry.total:
+                    raise
+                await self.sleep(self.retry.delay(attempt))
+                attempt += 1
+                continue
+
+            if not self.retry.is_retryable(response) or attempt >= self.retry.total:
+                return response
+
+            delay = self.retry.delay(attempt, response)
+            await response.aclose()
+            await self.sleep(delay)
+            attempt += 1
+
+    async def get(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('POST', path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+@asynccontextmanager
+async def _using(transport: Optional[AsyncTransport]) -> AsyncIterator[AsyncTransport]:
+    # Without a transport, one is opened for the call and closed afterwards
+    if transport is not None:
+        yield transport
+    else:
+        async with AsyncTransport() as transport:
+            yield transport
+
+
+async def send_async(auth_token: str, transformation_key: str, raw_data: Union[str, bytes], job_uuid: str,
+                     transport: AsyncTransport = None):
+    """Send data to the transformation API, as send does"""
+
+    headers = {
+        'Authorization': 'Bearer ' + auth_token,
+        'x-api-key': transformation_key
+    }
+    async with _using(transport) as transport:
+        if isinstance(raw_data, bytes):
+            binary_headers = {**headers, 'Content-Type': BINARY_CONTENT_TYPE, 'x-job-uuid': job_uuid}
+            response = await transport.post('/transform', headers=binary_headers, content=raw_data)
+            if response.status_code != 415:
+                return response
+            raw_data = await asyncio.to_thread(zip_payload, raw_data)
+
+        data = {
+            "raw_data": raw_data,
+            "job_uuid": job_uuid
+        }
+        headers['Content-Type'] = 'application/json'
+        return await transport.post('/transform', headers=headers, content=json.dumps(data))
+
+
+async def download_async(auth_token: str, transformation_key: str, process_uuid: str,
+                         transport: AsyncTransport = None, wire_format: str = 'json',
+                         instrumentation: Instrumentation = None, source_index: int = None, index: int = None,
+                         record_as_arrow: bool = False):
+    """Download the transformed data, as download does
+
+    The body is parsed as it streams in and each table is decoded in a worker thread as
+    soon as it is complete.
+    """
+
+    check_wire_format(wire_format)
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    params = {'process_uuid': process_uuid}
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + auth_token,
+        'x-api-key': transformation_key
+    }
+    accept = {'Accept': f"{MULTIPART_CONTENT_TYPE}, application/json"} if wire_format == 'binary' else {}
+
+    async with _using(transport) as transport:
+        with instrumentation.span('server_wait', source_index, index):
+            response = await transport.get('/download_output', params=params, headers=headers)
+
+        with instrumentation.span('download', source_index, index):
+            output = await transport.get(response.json()['data_url'], headers=accept, stream=True)
+        try:
+            with instrumentation.span('decode', source_index, index) as span:
+                content_type = output.headers.get('Content-Type', '')
+                multipart = content_type.startswith(MULTIPART_CONTENT_TYPE)
+                reader = MultipartReader(multipart_boundary(content_type)) if multipart else JSONTableReader()
+                tables = {}
+                async for piece in output.aiter_bytes(1024 * 1024):
+                    span.bytes += len(piece)
+                    for name, body in reader.feed(piece):
+                        tables[name] = await asyncio.to_thread(read_parquet_bytes, body,
+                                                               record_as_arrow and name == 'record')
+                if not reader.finished:
+                    raise ValueError(f"Incomplete {'multipart' if multipart else 'JSON'} response.")
+                tables = tuple(tables[name] for name in OUTPUT_TABLES)
+                span.rows = sum(len(table) for table in tables)
+        finally:
+            await output.aclose()
+
+    return tables
+
+
+async def transform_chunk_async(auth_token: str, transformation_key: str, chunk: Union[str, bytes], job_uuid: str,
+                                index: int = 0, transport: AsyncTransport = None, cache: ChunkCache = None,
+                                source_index: int = 0, instrumentation: Instrumentation = None,
+                                chunk_sizer: ChunkSizer = None):
+    """Send a single chunk to the transformation API and download its output, as transform_chunk does"""
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+
+    key = None
+    if cache is not None:
+        key, tables = await asyncio.to_thread(lookup_chunk, cache, transformation_key, chunk, source_index, index,
+                                              instrumentation)
+        if tables is not None:
+            return tables
+
+    start = time.perf_counter()
+    with instrumentation.span('upload', source_index, index, bytes=len(chunk)):
+        response = await send_async(auth_token, transformation_key, chunk, job_uuid, transport)
+
+    if response.status_code != 200:
+        logger.error("Process failed at chunk %s of source %s with response: %s.", index, source_index,
+                     response.content)
+        return None
+
+    logger.debug("Process succeeded at chunk %s of source %s.", index, source_index)
+
+    wire_format = 'binary' if isinstance(chunk, bytes) else 'json'
+    tables = await download_async(auth_token, transformation_key, response.json()['process_uuid'], transport,
+                                  wire_format, instrumentation, source_index, index)
+    if chunk_sizer is not None:
+        chunk_sizer.observe_latency(len(chunk), time.perf_counter() - start)
+
+    if cache is not None:
+        await asyncio.to_thread(store_chunk, cache, key, tables, source_index, index, instrumentation)
+
+    return tables
+
+
+async def collect_transformation_async(source: Source, auth_token: str, job_uuid: str,
+                                       accumulator: TableAccumulator, max_workers: int = 1,
+                                       transport: AsyncTransport = None, cache: ChunkCache = None,
+                                       source_index: int = 0, wire_format: str = 'json',
+                                       instrumentation: Instrumentation = None,
+                                       limit: asyncio.Semaphore = None) -> bool:
+    """Send a source in chunks to the transformation API, adding each chunk's output to accumulator
+
+    Chunks are read and encoded in a worker thread, and up to max_workers of them are
+    queued at once. Each chunk takes a slot of limit before it is read and frees it once it
+    is done, so sources sharing limit hold at most its value of chunks between them.
+    Results are added in chunk order.
+    Returns False if a chunk failed and the remaining chunks were skipped.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    limit = limit or asyncio.Semaphore(max_workers)
+    chunks = source.iter_encoded_chunks(wire_format, instrumentation, source_index)
+
+    async def run(index, chunk):
+        return await transform_chunk_async(auth_token, source.transformation_key, chunk, job_uuid, index,
+                                           transport, cache, source_index, instrumentation, source.chunk_sizer)
+
+    async def collect(task, index) -> bool:
+        tables = await task
+        if tables is None:
+            return False
+        with instrumentation.span('accumulate', source_index, index, rows=len(tables[2])):
+            accumulator.add(*tables)
+        return True
+
+    tasks = deque()
+    collected = 0
+    try:
+        while True:
+            await limit.acquire()
+            try:
+                chunk = await asyncio.to_thread(next, chunks, _DONE)
+            except BaseException:
+                limit.release()
+                raise
+            if chunk is _DONE:
+                limit.release()
+                break
+            task = asyncio.create_task(run(collected + len(tasks), chunk))
+            task.add_done_callback(lambda _: limit.release())
+            tasks.append(task)
+            if len(tasks) >= max_workers:
+                if not await collect(tasks.popleft(), collected):
+                    return False
+                collected += 1
+        while tasks:
+            if not await collect(tasks.popleft(), collected):
+                return False
+            collected += 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            chunks.close()
+        except ValueError:
+            # Still running in a worker thread after a cancellation; it is closed when collected
+            pass
+
+    return True
+
+
+async def apply_transformation_async(source: Source, auth_token: str, job_uuid: str, max_workers: int = 1,
+                                     transport: AsyncTransport = None, cache: ChunkCache = None,
+                                     wire_format: str = 'json', instrumentation: Instrumentation = None,
+                                     limit: asyncio.Semaphore = None):
+    """Send data in chunks to the transformation API, raising TransformationError if a chunk fails"""
+
+    accumulator = TableAccumulator()
+    status = SourceStatus(0, source.transformation_key)
+    async with _using(transport) as transport:
+        completed = await collect_transformation_async(source, auth_token, job_uuid, accumulator, max_workers,
+                                                       transport, cache, wire_format=wire_format,
+                                                       instrumentation=instrumentation, limit=limit)
+    status.record_attempt(accumulator, completed)
+    check_sources([status], None, job_uuid=job_uuid)
+    return await asyncio.to_thread(accumulator.result)
+
+
+async def run_source_async(source: Source, auth_token: str, job_uuid: str, max_workers: int = 1,
+                           transport: AsyncTransport = None, cache: ChunkCache = None, source_index: int = 0,
+                           wire_format: str = 'json', instrumentation: Instrumentation = None,
+                           limit: asyncio.Semaphore = None,
+                           source_retries: int = 1) -> Tuple[SourceStatus, Optional[TableAccumulator]]:
+    """Transform one source on its own with retries, as run_source does"""
+
+    status = SourceStatus(source_index, source.transformation_key)
+    start = time.perf_counter()
+    done = False
+    while not done:
+        accumulator = TableAccumulator()
+        error = None
+        try:
+            completed = await collect_transformation_async(source, auth_token, job_uuid, accumulator, max_workers,
+                                                           transport, cache, source_index, wire_format,
+                                                           instrumentation, limit)
+        except Exception as exception:
+            completed, error = False, repr(exception)
+        done = status.record_attempt(accumulator, completed, error, source_retries)
+
+    status.seconds = time.perf_counter() - start
+    return status, accumulator if status.succeeded else None
+
+
+async def transform_async(sources: List[Source], auth_token: str, max_workers: int = 1,
+                          transport: AsyncTransport = None, cache: ChunkCache = None, job_uuid: str = None,
+                          wire_format: str = 'json', instrumentation: Instrumentation = None,
+                          append_to: Output = None, limit: asyncio.Semaphore = None, source_retries: int = 1,
+                          allow_partial: bool = False):
+    """Apply transformation to the source data, as transform does
+
+    Sources are sent concurrently, with at most max_workers chunks in flight across all of
+    them. Pass the same limit semaphore to several calls to share one budget between jobs.
+    The output is the same as a transform of the sources in order, and failed sources are
+    retried and reported as transform does.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    limit = limit or asyncio.Semaphore(max_workers)
+
+    # Initialize the job uuid
+    if job_uuid is None:
+        job_uuid = str(uuid.uuid4())
+
+    # Check if the sources are valid Source objects
+    for source in sources:
+        if not isinstance(source, Source):
+            raise ValueError("Invalid source object. Use the hdata.Source class.")
+
+    async with _using(transport) as transport:
+        results = await asyncio.gather(*[
+            run_source_async(source, auth_token, job_uuid, max_workers, transport, cache, source_index, wire_format,
+                             instrumentation, limit, source_retries)
+            for source_index, source in enumerate(sources)])
+
+    return await asyncio.to_thread(finish_transform, results, job_uuid, cache, instrumentation, append_to,
+                                   allow_partial)
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import pandas as pd
+from typing import Optional, Tuple
+
+from .wire import OUTPUT_TABLES
+
+
+class ChunkCache:
+    """Local on-disk cache of transformed chunks
+
+    Each chunk's entity, attribute and record tables are stored as parquet files under a key
+    derived from the transformation key and a hash of the encoded chunk, so identical chunks
+    are served from disk in later runs. Rerunning a failed job with the same cache therefore
+    only sends the chunks that did not complete. Least recently used entries are evicted
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 10 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_directory = os.path.join(directory, 'chunks')
+        os.makedirs(self.chunk_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sizes = {key: self._entry_size(key) for key in os.listdir(self.chunk_directory)
+                       if not key.startswith('.')}
+
+    @staticmethod
+    def key(transformation_key: str, chunk) -> str:
+        digest = hashlib.sha256(transformation_key.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        return digest.hexdigest()
+
+    def _path(self, key: str, table: Optional[str] = None) -> str:
+        path = os.path.join(self.chunk_directory, key)
+        return path if table is None else os.path.join(path, f"{table}.parquet")
+
+    def _entry_size(self, key: str) -> int:
+        path = self._path(key)
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
+        """Return the cached tables for key, or None on a miss"""
+
+        if key not in self._sizes:
+            return None
+        try:
+            tables = tuple(pd.read_parquet(self._path(key, table)) for table in OUTPUT_TABLES)
+            os.utime(self._path(key))
+        except (FileNotFoundError, OSError):
+            # Evicted by another process
+            with self._lock:
+                self._sizes.pop(key, None)
+            return None
+        return tables
+
+    def put(self, key: str, entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame):
+        """Store a chunk's tables, replacing the entry atomically"""
+
+        staging = tempfile.mkdtemp(prefix='.', dir=self.chunk_directory)
+        try:
+            for table, frame in zip(OUTPUT_TABLES, (entity, attribute, record)):
+                frame.to_parquet(os.path.join(staging, f"{table}.parquet"), index=False)
+            with self._lock:
+                if os.path.exists(self._path(key)):
+                    shutil.rmtree(self._path(key))
+                os.replace(staging, self._path(key))
+                self._sizes[key] = self._entry_size(key)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+
+        with self._lock:
+            total = sum(self._sizes.values())
+            if total <= self.max_bytes:
+                return
+            ages = {}
+            for key in list(self._sizes):
+                try:
+                    ages[key] = os.path.getmtime(self._path(key))
+                except FileNotFoundError:
+                    # Evicted by another process
+                    total -= self._sizes.pop(key)
+            for key in sorted(ages, key=ages.get):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(self._path(key), ignore_errors=True)
+                total -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.chunk_directory, exist_ok=True)
+            self._sizes = {}
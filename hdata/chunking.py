@@ -0,0 +1,106 @@
+import threading
+import pandas as pd
+from typing import Callable, Iterable, Iterator, Optional
+
+MiB = 1024 ** 2
+
+
+class ChunkSizer:
+    """Chooses how many rows go in each chunk from a target encoded payload size
+
+    The bytes per row of a source are estimated by encoding a sample of its first rows, so
+    narrow tables get large chunks and wide tables small ones, and the row count for
+    target_bytes is clamped to [min_rows, max_rows].
+
+    With adaptive, the estimate is refined from every encoded chunk, and target_bytes is
+    tuned from the observed upload and transform latency: a chunk slower than
+    target_seconds shrinks the target in proportion, and one faster than a quarter of it
+    grows the target by half, between min_bytes and max_bytes. Adaptive chunk boundaries
+    depend on timing, so a resumed job only reuses cached chunks with fixed sizing.
+    """
+
+    def __init__(self, target_bytes: int = 8 * MiB, adaptive: bool = False, target_seconds: float = 30.0,
+                 min_bytes: int = MiB // 4, max_bytes: int = 64 * MiB, min_rows: int = 100, max_rows: int = 1_000_000,
+                 sample_rows: int = 5000):
+        self.target_bytes = target_bytes
+        self.adaptive = adaptive
+        self.target_seconds = target_seconds
+        # The bounds always include the starting target
+        self.min_bytes = min(min_bytes, target_bytes)
+        self.max_bytes = max(max_bytes, target_bytes)
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.sample_rows = sample_rows
+        self.bytes_per_row: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def copy(self) -> 'ChunkSizer':
+        """A sizer with the same settings and target, but no bytes per row estimate yet"""
+
+        return ChunkSizer(self.target_bytes, self.adaptive, self.target_seconds, self.min_bytes, self.max_bytes,
+                          self.min_rows, self.max_rows, self.sample_rows)
+
+    def rows(self) -> int:
+        """Rows for the next chunk"""
+
+        with self._lock:
+            if self.bytes_per_row is None:
+                return self.min_rows
+            return int(min(self.max_rows, max(self.min_rows, self.target_bytes // max(self.bytes_per_row, 1e-9))))
+
+    def calibrate(self, sample: pd.DataFrame, encode: Callable[[pd.DataFrame], bytes]):
+        """Estimate bytes per row by encoding up to sample_rows rows, unless already known"""
+
+        if self.bytes_per_row is None and len(sample):
+            sample = sample.iloc[:self.sample_rows]
+            with self._lock:
+                self.bytes_per_row = len(encode(sample)) / len(sample)
+
+    def observe_encoded(self, size: int, rows: int):
+        """Refine the bytes per row estimate from an encoded chunk, in adaptive mode"""
+
+        if not self.adaptive or not rows:
+            return
+        with self._lock:
+            bytes_per_row = size / rows
+            if self.bytes_per_row is None:
+                self.bytes_per_row = bytes_per_row
+            else:
+                self.bytes_per_row = 0.5 * self.bytes_per_row + 0.5 * bytes_per_row
+
+    def observe_latency(self, size: int, seconds: float):
+        """Tune target_bytes from the round trip time of a chunk of size bytes, in adaptive mode"""
+
+        if not self.adaptive:
+            return
+        with self._lock:
+            if seconds > self.target_seconds:
+                target = size * self.target_seconds / seconds
+                self.target_bytes = max(self.min_bytes, min(self.target_bytes, int(target)))
+            elif seconds < self.target_seconds / 4 and size >= self.target_bytes / 2:
+                self.target_bytes = min(self.max_bytes, int(self.target_bytes * 1.5))
+
+
+def rebatch(blocks: Iterable[pd.DataFrame], rows: Callable[[], int]) -> Iterator[pd.DataFrame]:
+    """Regroup a stream of frames into chunks of rows() rows, asking for the size of each chunk
+
+    The first size is asked for once the first block has been read, so a sizer can be
+    calibrated from it. The last chunk holds whatever remains.
+    """
+
+    buffer = []
+    buffered = 0
+    target = None
+    for block in blocks:
+        buffer.append(block)
+        buffered += len(block)
+        target = target or rows()
+        while buffered >= target:
+            frame = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+            yield frame.iloc[:target]
+            rest = frame.iloc[target:]
+            buffer = [rest] if len(rest) else []
+            buffered = len(rest)
+            target = rows()
+    if buffered:
+        yield pd.concat(buffer) if len(buffer) > 1 else buffer[0]
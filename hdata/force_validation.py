@@ -1,9 +1,120 @@
 import uuid
+import numpy as np
 import pandas as pd
-from time import time
+import pyarrow as pa
+import pyarrow.compute as pc
 import warnings
 import re
 
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation, logger
+
+VALID_DATE_PATTERN = r'^\d{4}(-\d{2}(-\d{2}( \d{2}:\d{2}(:\d{2})?)?)?)?$'
+VALID_RECORD_TYPES = (float, int, str, list, bool, bytes)
+ENGINES = ('vectorized', 'python')
+
+
+def check_engine(engine: str):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown validation engine: {engine}. Use one of {ENGINES}.")
+
+
+def _python_uuids(values) -> list:
+    return [str(uuid.UUID(x)) for x in values]
+
+
+def canonical_uuids(series: pd.Series, engine: str = 'vectorized') -> pd.Series:
+    """Convert a column of UUID strings to the canonical lower case hyphenated form
+
+    The vectorized engine strips hyphens, lower cases and checks for 32 hex digits with
+    pyarrow compute, then rebuilds the canonical form by slicing. Values that do not fit
+    that fast path (braces, urn prefixes, non-strings, invalid values) go through
+    uuid.UUID, so results and errors match the python engine exactly.
+    """
+
+    check_engine(engine)
+    if engine == 'python' or pd.api.types.infer_dtype(series, skipna=False) != 'string':
+        return pd.Series(_python_uuids(series), index=series.index, name=series.name)
+
+    values = pa.array(series, type=pa.large_string(), from_pandas=True)
+    hex_digits = pc.utf8_lower(pc.replace_substring(values, '-', ''))
+    fast = pc.match_substring_regex(hex_digits, '^[0-9a-f]{32}$')
+
+    parts = [pc.utf8_slice_codeunits(hex_digits, start, stop)
+             for start, stop in [(0, 8), (8, 12), (12, 16), (16, 20), (20, 32)]]
+    result = pc.binary_join_element_wise(*parts, pa.scalar('-', pa.large_string())).to_numpy(zero_copy_only=False)
+
+    if not pc.all(fast).as_py():
+        slow = ~fast.to_numpy(zero_copy_only=False)
+        result[slow] = _python_uuids(series.to_numpy(dtype=object)[slow])
+
+    return pd.Series(result, index=series.index, name=series.name)
+
+
+def dictionary_uuids(series: pd.Series, engine: str = 'vectorized') -> pd.Series:
+    """Canonicalize a UUID column as a categorical, parsing each distinct value once
+
+    Record tables repeat a small set of UUIDs across many rows, so the column is factorized
+    first and only the distinct values are canonicalized. Different spellings of the same
+    UUID share one category.
+    """
+
+    codes, uniques = pd.factorize(series)
+    canonical = canonical_uuids(pd.Series(uniques), engine)
+    canonical_codes, categories = pd.factorize(canonical)
+    categorical = pd.Categorical.from_codes(canonical_codes[codes], categories=categories)
+    return pd.Series(categorical, index=series.index, name=series.name)
+
+
+def encode_uuids(series: pd.Series, uuids: pd.Series) -> pd.Series:
+    """Re-encode a UUID column as a categorical whose categories are the given table's UUIDs
+
+    Values that are not in the table become null, so the category codes double as row
+    positions in the table and -1 marks a missing reference.
+    """
+
+    categories = pd.Index(uuids).rename(None)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Map the few distinct categories, then broadcast through the existing codes
+        positions = categories.get_indexer(series.cat.categories)
+        codes = series.cat.codes.to_numpy()
+        codes = np.where(codes < 0, -1, positions[codes])
+    else:
+        codes = categories.get_indexer(series)
+    categorical = pd.Categorical.from_codes(codes, categories=categories)
+    return pd.Series(categorical, index=series.index, name=series.name)
+
+
+def valid_datetimes(datetimes: pd.Series, engine: str = 'vectorized') -> bool:
+    """Check a column of datetime strings against VALID_DATE_PATTERN"""
+
+    check_engine(engine)
+    if engine == 'python':
+        return bool(datetimes.str.match(re.compile(VALID_DATE_PATTERN)).all())
+
+    values = pa.array(datetimes, type=pa.large_string(), from_pandas=True)
+    return bool(pc.all(pc.match_substring_regex(values, VALID_DATE_PATTERN)).as_py())
+
+
+def valid_record_values(values: pd.Series, engine: str = 'vectorized') -> bool:
+    """Check that every record value is one of VALID_RECORD_TYPES
+
+    The vectorized engine answers from the column dtype where it can: numpy numeric and
+    boolean columns and string columns always hold valid values. Object columns are
+    inferred in C and only fall back to the per-element check when they hold mixed or
+    numpy scalar types.
+    """
+
+    check_engine(engine)
+    if engine == 'vectorized':
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biuf':
+            return True
+        if pd.api.types.is_string_dtype(values.dtype) and not values.dtype == object:
+            return True
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) in ('string', 'bytes', 'empty'):
+            return True
+
+    return all(isinstance(x, VALID_RECORD_TYPES) for x in values)
+
 
 def column_validation(entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame):
 
@@ -30,7 +141,7 @@ def column_validation(entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.
     return entity, attribute, record
 
 
-def validate_entity(entity: pd.DataFrame) -> pd.DataFrame:
+def validate_entity(entity: pd.DataFrame, engine: str = 'vectorized') -> pd.DataFrame:
     """Clean and validate the entity table from the data transformation process."""
 
     if entity["entity_uuid"].isnull().values.any():
@@ -39,26 +150,28 @@ def validate_entity(entity: pd.DataFrame) -> pd.DataFrame:
     if entity["entity_name"].isnull().values.any():
         raise Exception(
             "The entity_name column must not contain null values.")
+    # Canonicalize first, so spellings of the same UUID count as duplicates
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        entity["entity_uuid"] = canonical_uuids(entity["entity_uuid"], engine)
     if entity["entity_uuid"].duplicated().any():
-        print(
-            f"WARNING: Duplicate entity_uuids detected. Dropping duplicates:{entity[entity['entity_uuid'].duplicated()]['entity_uuid'].values}")
+        logger.warning("Duplicate entity_uuids detected. Dropping duplicates:%s",
+                       entity[entity['entity_uuid'].duplicated()]['entity_uuid'].values)
         entity = entity.drop_duplicates(subset=["entity_uuid"])
     if entity["entity_name"].duplicated().any():
-        print(
-            f"WARNING: Duplicate entity_names detected. Dropping duplicates:{entity[entity['entity_name'].duplicated()]['entity_name'].values}")
+        logger.warning("Duplicate entity_names detected. Dropping duplicates:%s",
+                       entity[entity['entity_name'].duplicated()]['entity_name'].values)
         entity = entity.drop_duplicates(subset=["entity_name"])
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        entity["entity_uuid"] = entity["entity_uuid"].apply(
-            lambda x: str(uuid.UUID(x)))
         entity["entity_description"] = entity["entity_description"].fillna(
             "").astype(str)
 
     return entity
 
 
-def validate_attribute(attribute: pd.DataFrame) -> pd.DataFrame:
+def validate_attribute(attribute: pd.DataFrame, engine: str = 'vectorized') -> pd.DataFrame:
     """Clean and validate the attribute table from the data transformation process."""
 
     if attribute["attribute_uuid"].isnull().values.any():
@@ -67,17 +180,17 @@ def validate_attribute(attribute: pd.DataFrame) -> pd.DataFrame:
     if attribute["attribute_name"].isnull().values.any():
         raise Exception(
             "The attribute_name column must not contain null values.")
+    # Canonicalize first, so spellings of the same UUID count as duplicates
+    attribute["attribute_uuid"] = canonical_uuids(attribute["attribute_uuid"], engine)
     if attribute["attribute_uuid"].duplicated().any():
-        print(
-            f"WARNING: Duplicate attribute_uuids detected. Dropping duplicates:{attribute[attribute['attribute_uuid'].duplicated()]['attribute_uuid'].values}")
+        logger.warning("Duplicate attribute_uuids detected. Dropping duplicates:%s",
+                       attribute[attribute['attribute_uuid'].duplicated()]['attribute_uuid'].values)
         attribute = attribute.drop_duplicates(subset=["attribute_uuid"])
     if attribute["attribute_name"].duplicated().any():
-        print(
-            f"WARNING: Duplicate attribute_names detected. Dropping duplicates:{attribute[attribute['attribute_name'].duplicated()]['attribute_name'].values}")
+        logger.warning("Duplicate attribute_names detected. Dropping duplicates:%s",
+                       attribute[attribute['attribute_name'].duplicated()]['attribute_name'].values)
         attribute = attribute.drop_duplicates(subset=["attribute_name"])
 
-    attribute["attribute_uuid"] = attribute["attribute_uuid"].apply(
-        lambda x: str(uuid.UUID(x)))
     attribute["attribute_name"] = attribute["attribute_name"].str.lower()
     attribute["attribute_description"] = attribute["attribute_description"].fillna(
         "").astype(str)
@@ -85,8 +198,13 @@ def validate_attribute(attribute: pd.DataFrame) -> pd.DataFrame:
     return attribute
 
 
-def validate_record(record: pd.DataFrame) -> pd.DataFrame:
-    """Optimized clean and validate function for the record table."""
+def validate_record(record: pd.DataFrame, engine: str = 'vectorized') -> pd.DataFrame:
+    """Optimized clean and validate function for the record table.
+
+    engine selects the vectorized pyarrow checks or the original per-row python checks.
+    """
+
+    check_engine(engine)
 
     # Check for null values in essential columns
     if record[["datetime", "entity_uuid", "attribute_uuid"]].isnull().any().any():
@@ -106,71 +224,85 @@ def validate_record(record: pd.DataFrame) -> pd.DataFrame:
         warnings.simplefilter("ignore")
         record["datetime"] = record["datetime"].astype(str)
 
-    valid_date_pattern = re.compile(
-        r'^\d{4}(-\d{2}(-\d{2}( \d{2}:\d{2}(:\d{2})?)?)?)?$')
-    if not record["datetime"].str.match(valid_date_pattern).all():
+    if not valid_datetimes(record["datetime"], engine):
         raise Exception("Invalid datetime format detected.")
 
     # Validate and format UUID columns efficiently
     for col in ["entity_uuid", "attribute_uuid"]:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            record[col] = record[col].map(lambda x: str(uuid.UUID(x)))
+            if engine == 'vectorized':
+                record[col] = dictionary_uuids(record[col], engine)
+            else:
+                record[col] = canonical_uuids(record[col], engine)
 
     # Ensure valid types in 'record_value' column
-    valid_types = (float, int, str, list, bool, bytes)
-    if not all(isinstance(x, valid_types) for x in record["record_value"]):
+    if not valid_record_values(record["record_value"], engine):
         raise Exception("Invalid types found in 'record_value' column.")
 
     return record
 
 
 def uuid_match_validation(entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame):
+    """Check record UUIDs against the entity and attribute tables
+
+    The record UUID columns are returned as categoricals whose categories are the entity and
+    attribute table UUIDs, so the checks compare integer category codes instead of strings.
+    """
+
+    entity_uuid = encode_uuids(record['entity_uuid'], entity['entity_uuid'])
+    attribute_uuid = encode_uuids(record['attribute_uuid'], attribute['attribute_uuid'])
+    entity_codes = entity_uuid.cat.codes.to_numpy()
+    attribute_codes = attribute_uuid.cat.codes.to_numpy()
+
     # Check that all entity_uuids and attribute_uuids in the record table exist in their respective tables
-    if not record['entity_uuid'].isin(entity['entity_uuid']).all():
+    if (entity_codes < 0).any():
         raise ValueError(
             "All entity_uuids in the record table must exist in the entity table.")
-    if not record['attribute_uuid'].isin(attribute['attribute_uuid']).all():
+    if (attribute_codes < 0).any():
         raise ValueError(
             "All attribute_uuids in the record table must exist in the attribute table.")
 
     # Check that all entity_uuids and attribute_uuids in the entity and attribute tables are used in the record table
-    if not entity['entity_uuid'].isin(record['entity_uuid']).all():
+    if not np.bincount(entity_codes, minlength=len(entity)).all():
         raise ValueError(
             "All entity_uuids in the entity table must be used in the record table.")
-    if not attribute['attribute_uuid'].isin(record['attribute_uuid']).all():
-        print("WARNING: Not all attribute_uuids in the attribute table are used in the record table.")
+    if not np.bincount(attribute_codes, minlength=len(attribute)).all():
+        logger.warning("Not all attribute_uuids in the attribute table are used in the record table.")
+
+    record = record.assign(entity_uuid=entity_uuid, attribute_uuid=attribute_uuid)
 
     return entity, attribute, record
 
 
-def validate_output(entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame) -> dict:
-    """Clean and validate the three output tables from the data transformation process."""
+def validate_output(entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame,
+                    engine: str = 'vectorized', instrumentation: Instrumentation = None) -> dict:
+    """Clean and validate the three output tables from the data transformation process.
+
+    Each step is recorded as a validate.* span on instrumentation.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
 
     # Column validation
-    t_columns = time()
-    entity, attribute, record = column_validation(entity, attribute, record)
-    print(f"Column validation: {time() - t_columns}")
+    with instrumentation.span('validate.columns', rows=len(record)):
+        entity, attribute, record = column_validation(entity, attribute, record)
 
     # Entity table validation
-    t_entity = time()
-    entity = validate_entity(entity)
-    print(f"Entity table validation: {time() - t_entity}")
+    with instrumentation.span('validate.entity', rows=len(entity)):
+        entity = validate_entity(entity, engine)
 
     # Attribute table validation
-    t_attribute = time()
-    attribute = validate_attribute(attribute)
-    print(f"Attribute table validation: {time() - t_attribute}")
+    with instrumentation.span('validate.attribute', rows=len(attribute)):
+        attribute = validate_attribute(attribute, engine)
 
     # Record table validation
-    t_record = time()
-    record = validate_record(record)
-    print(f"Record table validation: {time() - t_record}")
+    with instrumentation.span('validate.record', rows=len(record)):
+        record = validate_record(record, engine)
 
     # Check that all entity_uuids and attribute_uuids in the record table exist in their respective tables
-    t_uuid_match = time()
-    entity, attribute, record = uuid_match_validation(
-        entity, attribute, record)
-    print(f"UUID match validation: {time() - t_uuid_match}")
+    with instrumentation.span('validate.uuid_match', rows=len(record)):
+        entity, attribute, record = uuid_match_validation(
+            entity, attribute, record)
 
     return entity, attribute, record
@@ -1,125 +1,457 @@
 from .models import Source, Output
 from .force_validation import validate_output
+from .accumulator import TableAccumulator
+from .cache import ChunkCache
+from .chunking import ChunkSizer
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation, Span, logger
+from .pool import ordered_map
+from .transport import Transport, get_default_transport
+from .wire import (BINARY_CONTENT_TYPE, MULTIPART_CONTENT_TYPE, check_wire_format, decode_json_stream,
+                   decode_multipart_output, zip_payload)
 
-import base64
 import uuid
-import io
-import pandas as pd
-import requests
 import json
+import threading
 import time
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 
-def send(auth_token: str, transformation_key: str, raw_data: str, job_uuid: str):
-    """Send data to the transformation API"""
+def pooled_transport(transport: Optional[Transport], max_workers: int) -> Transport:
+    """The transport to use for max_workers concurrent chunks
 
-    url = 'https://api.hyperdata.so/transform'
-    data = {
-        "raw_data": raw_data,
-        "job_uuid": job_uuid
-    }
+    The shared default transport's pool is grown to max_workers connections. A transport
+    passed in is used as is, with a warning if its pool is too small to keep every
+    connection alive.
+    """
+
+    if transport is None:
+        transport = get_default_transport()
+        transport.ensure_pool_size(max_workers)
+    elif transport.pool_maxsize < max_workers:
+        logger.warning("max_workers=%s exceeds the transport's pool_maxsize=%s, so extra connections are discarded "
+                       "after each request. Create the Transport with pool_maxsize=%s.", max_workers,
+                       transport.pool_maxsize, max_workers)
+    return transport
+
+
+def send(auth_token: str, transformation_key: str, raw_data: Union[str, bytes], job_uuid: str,
+         transport: Transport = None):
+    """Send data to the transformation API
+
+    raw_data is a base64 zipped parquet string for the json wire format, or parquet bytes
+    for the binary wire format, which are posted as the raw request body. If the API answers
+    a binary upload with 415 Unsupported Media Type, the chunk is resent as json.
+    """
+
+    transport = transport or get_default_transport()
     headers = {
-        'Content-Type': 'application/json',
         'Authorization': 'Bearer ' + auth_token,
         'x-api-key': transformation_key
     }
 
-    response = requests.post(url, headers=headers,
-                             data=json.dumps(data), stream=True)
+    if isinstance(raw_data, bytes):
+        binary_headers = {**headers, 'Content-Type': BINARY_CONTENT_TYPE, 'x-job-uuid': job_uuid}
+        response = transport.post('/transform', headers=binary_headers, data=raw_data)
+        if response.status_code != 415:
+            return response
+        raw_data = zip_payload(raw_data)
+
+    data = {
+        "raw_data": raw_data,
+        "job_uuid": job_uuid
+    }
+    headers['Content-Type'] = 'application/json'
+
+    response = transport.post('/transform', headers=headers, data=json.dumps(data))
 
     return response
 
 
-def download(auth_token: str, transformation_key: str, process_uuid: str):
-    """Download the transformed data"""
+def _counted(pieces: Iterable[bytes], span: Span) -> Iterator[bytes]:
+    for piece in pieces:
+        span.bytes += len(piece)
+        yield piece
+
+
+def download(auth_token: str, transformation_key: str, process_uuid: str, transport: Transport = None,
+             wire_format: str = 'json', instrumentation: Instrumentation = None, source_index: int = None,
+             index: int = None, record_as_arrow: bool = False):
+    """Download the transformed data
 
+    The output is decoded as the response streams in: with the binary wire format it is
+    requested as multipart/mixed raw parquet tables, otherwise the JSON body is parsed
+    incrementally and each base64 table decoded once its string is complete. Either way the
+    decode span also covers reading the body. With record_as_arrow the record table is
+    returned as an Arrow table rather than converted to pandas.
+    """
+
+    check_wire_format(wire_format)
+    transport = transport or get_default_transport()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
     params = {'process_uuid': process_uuid}
     headers = {
         'Content-Type': 'application/json',
         'Authorization': 'Bearer ' + auth_token,
         'x-api-key': transformation_key
     }
-    response = requests.get('https://api.hyperdata.so/download_output', params=params, headers=headers)
+    with instrumentation.span('server_wait', source_index, index):
+        response = transport.get('/download_output', params=params, headers=headers)
+
+    accept = {'Accept': f"{MULTIPART_CONTENT_TYPE}, application/json"} if wire_format == 'binary' else {}
+    with instrumentation.span('download', source_index, index):
+        output = transport.get(response.json()['data_url'], headers=accept, stream=True)
+        content_type = output.headers.get('Content-Type', '')
+
+    with instrumentation.span('decode', source_index, index) as span:
+        pieces = _counted(output.iter_content(chunk_size=1024 * 1024), span)
+        if content_type.startswith(MULTIPART_CONTENT_TYPE):
+            tables = decode_multipart_output(pieces, content_type, record_as_arrow)
+        else:
+            tables = decode_json_stream(pieces, record_as_arrow)
+        span.rows = sum(len(table) for table in tables)
+
+    return tables
+
+
+def lookup_chunk(cache: ChunkCache, transformation_key: str, chunk: Union[str, bytes], source_index: int = 0,
+                 index: int = 0, instrumentation: Instrumentation = None) -> Tuple[str, Optional[tuple]]:
+    """Return a chunk's cache key and its cached tables, or None on a miss"""
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    key = cache.key(transformation_key, chunk)
+    with instrumentation.span('cache', source_index, index) as span:
+        tables = cache.get(key)
+        if tables is not None:
+            span.rows = sum(len(table) for table in tables)
+    if tables is not None:
+        logger.debug("Chunk %s of source %s served from cache.", index, source_index)
+    return key, tables
+
+
+def store_chunk(cache: ChunkCache, key: str, tables: tuple, source_index: int = 0, index: int = 0,
+                instrumentation: Instrumentation = None):
+    """Store a transformed chunk's tables in cache"""
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    with instrumentation.span('cache', source_index, index):
+        cache.put(key, *tables)
+
+
+def transform_chunk(auth_token: str, transformation_key: str, chunk: Union[str, bytes], job_uuid: str, index: int = 0,
+                    transport: Transport = None, cache: ChunkCache = None, source_index: int = 0,
+                    instrumentation: Instrumentation = None, chunk_sizer: ChunkSizer = None):
+    """Send a single chunk to the transformation API and download its output
+
+    Throttled and failed requests are retried by the transport. With a cache, chunks that
+    were transformed before are read from disk instead, and new outputs are stored. The
+    round trip time of chunks sent to the API is reported to chunk_sizer.
+    Returns the entity, attribute and record tables, or None if the chunk still failed.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+
+    key = None
+    if cache is not None:
+        key, tables = lookup_chunk(cache, transformation_key, chunk, source_index, index, instrumentation)
+        if tables is not None:
+            return tables
+
+    start = time.perf_counter()
+    with instrumentation.span('upload', source_index, index, bytes=len(chunk)):
+        response = send(auth_token, transformation_key, chunk, job_uuid, transport)
+
+    if response.status_code != 200:
+        logger.error("Process failed at chunk %s of source %s with response: %s.", index, source_index,
+                     response.content)
+        return None
+
+    logger.debug("Process succeeded at chunk %s of source %s.", index, source_index)
+
+    wire_format = 'binary' if isinstance(chunk, bytes) else 'json'
+    tables = download(auth_token, transformation_key, response.json()['process_uuid'], transport, wire_format,
+                      instrumentation, source_index, index)
+    if chunk_sizer is not None:
+        chunk_sizer.observe_latency(len(chunk), time.perf_counter() - start)
+
+    if cache is not None:
+        store_chunk(cache, key, tables, source_index, index, instrumentation)
+
+    return tables
 
-    output = requests.get(response.json()['data_url'], stream=True).json()
 
-    entity = pd.read_parquet(io.BytesIO(base64.b64decode(output['entity'])))
-    attribute = pd.read_parquet(io.BytesIO(base64.b64decode(output['attribute'])))
-    record = pd.read_parquet(io.BytesIO(base64.b64decode(output['record'])))
-    return entity, attribute, record
+class SourceStatus:
+    """Outcome of one source of a transform: its state, attempts, chunks, rows and last error"""
 
+    __slots__ = ('source', 'transformation_key', 'state', 'attempts', 'chunks', 'rows', 'seconds', 'error')
 
-def apply_transformation(source: Source, auth_token: str, job_uuid: str):
-    """Send data in chunks to the transformation API"""
+    def __init__(self, source: int, transformation_key: str):
+        self.source = source
+        self.transformation_key = transformation_key
+        self.state = 'pending'
+        self.attempts = 0
+        self.chunks = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.state == 'succeeded'
+
+    def record_attempt(self, accumulator: TableAccumulator, completed: bool, error: Optional[str] = None,
+                       retries: int = 0) -> bool:
+        """Record the outcome of one attempt at the source, returning True once no retry follows"""
+
+        self.attempts += 1
+        if completed:
+            self.state = 'succeeded'
+            self.chunks = len(accumulator)
+            self.rows = sum(len(record) for record in accumulator.record)
+            self.error = None
+            return True
+        self.error = error or f"Chunk {len(accumulator)} failed."
+        if self.attempts > retries:
+            self.state = 'failed'
+            return True
+        logger.warning("Source %s failed: %s Retrying it, attempt %s of %s.", self.source, self.error,
+                       self.attempts + 1, retries + 1)
+        return False
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"SourceStatus({', '.join(f'{key}={value!r}' for key, value in self.as_dict().items())})"
+
+
+class TransformationError(Exception):
+    """Raised by transform when sources still failed after their retries
+
+    output holds the validated tables of the sources that succeeded, or None if none did,
+    source_status the status of every source, and job_uuid the job to pass to transform,
+    with the same cache, to resume it.
+    """
+
+    def __init__(self, message: str, output: Optional[Output], source_status: List[SourceStatus],
+                 job_uuid: Optional[str] = None):
+        super().__init__(message)
+        self.output = output
+        self.source_status = source_status
+        self.job_uuid = job_uuid
+
+
+def collect_transformation(source: Source, auth_token: str, job_uuid: str, accumulator: TableAccumulator,
+                           max_workers: int = 1, transport: Transport = None, cache: ChunkCache = None,
+                           source_index: int = 0, wire_format: str = 'json',
+                           instrumentation: Instrumentation = None, executor: ThreadPoolExecutor = None,
+                           limit: threading.Semaphore = None) -> bool:
+    """Send a source in chunks to the transformation API, adding each chunk's output to accumulator
+
+    With max_workers > 1, up to max_workers chunks are in flight at once on a thread pool.
+    Pass an executor to run chunks on a pool shared with other sources instead, and a limit
+    semaphore shared with them to bound the chunks read and encoded across all of them.
+    Results are still added in chunk order, so the output matches a serial run. Returns
+    False if a chunk failed and the remaining chunks were skipped.
+    """
 
     transformation_key = source.transformation_key
-    entity = pd.DataFrame()
-    attribute = pd.DataFrame()
-    record = pd.DataFrame()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    chunks = enumerate(source.iter_encoded_chunks(wire_format, instrumentation, source_index))
 
-    for index, chunk in enumerate(source.zipped_chunks):
+    def run(indexed_chunk):
+        index, chunk = indexed_chunk
+        return transform_chunk(auth_token, transformation_key, chunk, job_uuid, index, transport, cache, source_index,
+                               instrumentation, source.chunk_sizer)
 
-        response = send(auth_token, transformation_key, chunk, job_uuid)
+    shared = executor is not None
+    if not shared and max_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    if executor is not None:
+        results = ordered_map(run, chunks, executor, max_workers, limit)
+    else:
+        results = map(run, chunks)
 
-        if response.status_code != 200:
-            print(f"Process failed at chunk {index} with response: {response.content}. Trying again in 20s.")
-            time.sleep(20)
-            response = send(auth_token, transformation_key, chunk)
-            if response.status_code != 200:
-                print(f"Process failed at chunk {index} with response: {response.content}. Exiting.")
-                return entity, attribute, record
-        else:
-            print(f"Process succeeded at chunk {index}.")
+    try:
+        for index, tables in enumerate(results):
+            if tables is None:
+                return False
+            with instrumentation.span('accumulate', source_index, index, rows=len(tables[2])):
+                accumulator.add(*tables)
+    finally:
+        if executor is not None:
+            results.close()
+            if not shared:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    return True
+
+
+def apply_transformation(source: Source, auth_token: str, job_uuid: str, max_workers: int = 1,
+                         transport: Transport = None, cache: ChunkCache = None, wire_format: str = 'json',
+                         instrumentation: Instrumentation = None):
+    """Send data in chunks to the transformation API
+
+    Raises TransformationError if a chunk still fails after the transport's retries.
+    """
+
+    transport = pooled_transport(transport, max_workers)
+    accumulator = TableAccumulator()
+    status = SourceStatus(0, source.transformation_key)
+    completed = collect_transformation(source, auth_token, job_uuid, accumulator, max_workers, transport, cache,
+                                       wire_format=wire_format, instrumentation=instrumentation)
+    status.record_attempt(accumulator, completed)
+    check_sources([status], None, job_uuid=job_uuid)
+    return accumulator.result()
+
+
+def run_source(source: Source, auth_token: str, job_uuid: str, max_workers: int = 1, transport: Transport = None,
+               cache: ChunkCache = None, source_index: int = 0, wire_format: str = 'json',
+               instrumentation: Instrumentation = None, executor: ThreadPoolExecutor = None,
+               source_retries: int = 1,
+               limit: threading.Semaphore = None) -> Tuple[SourceStatus, Optional[TableAccumulator]]:
+    """Transform one source on its own, retrying the whole source up to source_retries times
 
-            new_entity, new_attribute, new_record = download(
-                auth_token, transformation_key, response.json()['process_uuid'])
+    Chunk outputs of a failed attempt are discarded, so a source contributes all of its
+    chunks or none. With a cache, a retry only resends the chunks that did not complete.
+    Returns the source's status and, if it succeeded, its accumulated chunks.
+    """
 
-            if entity.empty:
-                entity = pd.DataFrame(columns=new_entity.columns)
-            if attribute.empty:
-                attribute = pd.DataFrame(columns=new_attribute.columns)
-            if record.empty:
-                record = pd.DataFrame(columns=new_record.columns)
+    status = SourceStatus(source_index, source.transformation_key)
+    start = time.perf_counter()
+    done = False
+    while not done:
+        accumulator = TableAccumulator()
+        error = None
+        try:
+            completed = collect_transformation(source, auth_token, job_uuid, accumulator, max_workers, transport,
+                                               cache, source_index, wire_format, instrumentation, executor, limit)
+        except Exception as exception:
+            completed, error = False, repr(exception)
+        done = status.record_attempt(accumulator, completed, error, source_retries)
 
-            entity = pd.concat([entity, new_entity], ignore_index=True, sort=False)
-            attribute = pd.concat([attribute, new_attribute], ignore_index=True, sort=False)
-            record = pd.concat([record, new_record], ignore_index=True, sort=False)
+    status.seconds = time.perf_counter() - start
+    return status, accumulator if status.succeeded else None
 
-    return entity, attribute, record
 
+def combine_sources(results: List[Tuple[SourceStatus, Optional[TableAccumulator]]], job_uuid: str,
+                    cache: ChunkCache = None) -> TableAccumulator:
+    """Collect the chunks of the sources that succeeded, in source order"""
 
-def transform(sources: List[Source], auth_token: str):
-    """Apply transformation to the source data"""
+    accumulator = TableAccumulator()
+    for status, source_accumulator in results:
+        if source_accumulator is not None:
+            accumulator.extend(source_accumulator)
+    if cache is not None and not all(status.succeeded for status, _ in results):
+        logger.warning("Job %s is incomplete. Call transform again with job_uuid='%s' and the same cache "
+                       "to resume.", job_uuid, job_uuid)
+    return accumulator
 
-    entity = pd.DataFrame()
-    attribute = pd.DataFrame()
-    record = pd.DataFrame()
+
+def check_sources(statuses: List[SourceStatus], output: Optional[Output], allow_partial: bool = False,
+                  job_uuid: Optional[str] = None):
+    """Raise TransformationError for failed sources, or only log them with allow_partial"""
+
+    failed = [status for status in statuses if not status.succeeded]
+    if not failed:
+        return
+    message = f"{len(failed)} of {len(statuses)} sources failed: " + "; ".join(
+        f"source {status.source}: {status.error}" for status in failed)
+    if allow_partial and output is not None:
+        logger.warning("%s. Returning the output of the sources that succeeded.", message)
+        return
+    raise TransformationError(message, output, statuses, job_uuid)
+
+
+def finish_transform(results: List[Tuple[SourceStatus, Optional[TableAccumulator]]], job_uuid: str,
+                     cache: ChunkCache = None, instrumentation: Instrumentation = None, append_to: Output = None,
+                     allow_partial: bool = False) -> Output:
+    """Combine and validate the chunks of the sources that succeeded into an Output
+
+    The Output carries the job_uuid and the status of every source. Failed sources raise TransformationError
+    unless allow_partial is set, and the Output is only appended to append_to otherwise.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    statuses = [status for status, _ in results]
+
+    accumulator = combine_sources(results, job_uuid, cache)
+    if not any(status.succeeded for status in statuses):
+        check_sources(statuses, None, job_uuid=job_uuid)
+
+    with instrumentation.span('accumulate') as span:
+        entity, attribute, record = accumulator.result()
+        span.rows = len(record)
+
+    # Validate the output
+    entity, attribute, record = validate_output(entity, attribute, record, instrumentation=instrumentation)
+
+    output = Output(entity, attribute, record)
+    output.job_uuid, output.source_status = job_uuid, statuses
+    # Raise before appending, so append_to is left as it was when sources failed
+    check_sources(statuses, output, allow_partial, job_uuid)
+    if append_to is not None:
+        output = append_to.append(output, instrumentation)
+        output.job_uuid, output.source_status = job_uuid, statuses
+    return output
+
+
+def transform(sources: List[Source], auth_token: str, max_workers: int = 1, transport: Transport = None,
+              cache: ChunkCache = None, job_uuid: str = None, wire_format: str = 'json',
+              instrumentation: Instrumentation = None, append_to: Output = None, max_sources: int = None,
+              source_retries: int = 1, allow_partial: bool = False):
+    """Apply transformation to the source data
+
+    Sources are transformed in parallel, up to max_sources at once (max_workers by default),
+    and max_workers bounds the chunks read, encoded and in flight across all sources together.
+    transport defaults to the shared pooled transport, whose pool is grown to max_workers
+    connections; pass one to change timeouts, retries or the API host. With a cache, each
+    chunk's output is checkpointed to disk. To resume a failed job, pass the same cache and
+    job_uuid (the job_uuid of the output, or of the TransformationError): completed chunks
+    are read from the cache and the rest are sent under the same job.
+    wire_format 'binary' uploads and downloads raw parquet instead of base64 JSON.
+    Pass an Instrumentation to collect per-stage timings of the run. With append_to, only
+    the new data is validated, then appended to that Output, which is returned.
+
+    Each source succeeds or fails as a whole, and a failed source is retried on its own up
+    to source_retries times. The output's source_status lists the outcome of every source.
+    If a source still fails, TransformationError is raised, carrying the output of the
+    sources that succeeded, and append_to is left unchanged; with allow_partial that output
+    is returned (and appended) instead.
+    """
+
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    transport = pooled_transport(transport, max_workers)
 
     # Initialize the job uuid
-    job_uuid = str(uuid.uuid4())
+    if job_uuid is None:
+        job_uuid = str(uuid.uuid4())
 
     # Check if the sources are valid Source objects
     for source in sources:
         if not isinstance(source, Source):
             raise ValueError("Invalid source object. Use the hdata.Source class.")
 
-    # Apply transformation to each source
-    for source in sources:
-        new_entity, new_attribute, new_record = apply_transformation(source, auth_token, job_uuid)
-
-        if entity.empty:
-            entity = pd.DataFrame(columns=new_entity.columns)
-        if attribute.empty:
-            attribute = pd.DataFrame(columns=new_attribute.columns)
-        if record.empty:
-            record = pd.DataFrame(columns=new_record.columns)
+    # Transform the sources side by side, sharing one pool of chunk workers between them
+    max_sources = min(max_sources or max_workers, len(sources)) or 1
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 or max_sources > 1 else None
+    limit = threading.Semaphore(max_workers)
+    source_executor = ThreadPoolExecutor(max_workers=max_sources) if max_sources > 1 else None
 
-        entity = pd.concat([entity, new_entity], ignore_index=True, sort=False)
-        attribute = pd.concat([attribute, new_attribute], ignore_index=True, sort=False)
-        record = pd.concat([record, new_record], ignore_index=True, sort=False)
+    def run(indexed_source):
+        source_index, source = indexed_source
+        return run_source(source, auth_token, job_uuid, max_workers, transport, cache, source_index, wire_format,
+                          instrumentation, executor, source_retries, limit)
 
-    # Validate the output
-    entity, attribute, record = validate_output(entity, attribute, record)
+    try:
+        if source_executor is not None:
+            results = list(source_executor.map(run, enumerate(sources)))
+        else:
+            results = list(map(run, enumerate(sources)))
+    finally:
+        if source_executor is not None:
+            source_executor.shutdown(wait=True, cancel_futures=True)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
 
-    return Output(entity, attribute, record)
+    return finish_transform(results, job_uuid, cache, instrumentation, append_to, allow_partial)
@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+from typing import Any, Iterable, Optional
+from uuid import UUID
+
+
+def _positions(column: pd.Series, uuids: pd.Series) -> np.ndarray:
+    """Position of each value of column in uuids, or -1 when it is missing"""
+
+    table = pd.Index(uuids)
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        lookup = table.get_indexer(column.cat.categories)
+        codes = column.cat.codes.to_numpy()
+        return np.where(codes < 0, -1, lookup[codes]) if len(lookup) else np.full(len(codes), -1)
+    return table.get_indexer(column)
+
+
+def _sort_keys(datetimes: pd.Series) -> np.ndarray:
+    """Datetime values as a numpy array that sorts like the column compares
+
+    Validated datetime columns hold ASCII strings, which are stored as fixed width bytes
+    so sorting and binary search run in C.
+    """
+
+    if pd.api.types.is_string_dtype(datetimes.dtype):
+        values = datetimes.to_numpy(dtype=object)
+        try:
+            return values.astype('S')
+        except (UnicodeEncodeError, TypeError):
+            return values
+    return datetimes.to_numpy()
+
+
+class Postings:
+    """Record row positions grouped by a key, each group sorted by datetime
+
+    Stored as one positions array plus offsets, so group g is
+    positions[offsets[g]:offsets[g + 1]].
+    """
+
+    def __init__(self, keys: np.ndarray, order: np.ndarray, groups: int):
+        ordered_keys = keys[order]
+        valid = ordered_keys >= 0
+        grouped = np.argsort(ordered_keys[valid], kind='stable')
+        self.positions = order[valid][grouped]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(ordered_keys[valid], minlength=groups))])
+
+    def extend(self, keys: np.ndarray, rows: np.ndarray, datetimes: np.ndarray, groups: int):
+        """Insert new record rows, given in datetime order, into their groups in place
+
+        datetimes holds the sort keys of every record row. Each group touched by the new rows
+        is searched once, so the cost follows the number of new rows, not the table size.
+        """
+
+        valid = keys >= 0
+        grouped = np.argsort(keys[valid], kind='stable')
+        keys, rows = keys[valid][grouped], rows[valid][grouped]
+        counts = np.bincount(keys, minlength=groups)
+        offsets = np.concatenate([self.offsets, np.full(groups + 1 - len(self.offsets), self.offsets[-1])])
+
+        where = np.empty(len(rows), dtype=np.intp)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        for group in np.flatnonzero(counts):
+            new = slice(starts[group], starts[group + 1])
+            existing = self.positions[offsets[group]:offsets[group + 1]]
+            # Ties go after existing rows, as a stable sort of the combined table would place them
+            where[new] = offsets[group] + np.searchsorted(datetimes[existing], datetimes[rows[new]], side='right')
+
+        self.positions = np.insert(self.positions, where, rows)
+        self.offsets = offsets + np.concatenate([[0], np.cumsum(counts)])
+
+    def size(self, group: int) -> int:
+        return int(self.offsets[group + 1] - self.offsets[group])
+
+    def get(self, group: int) -> np.ndarray:
+        return self.positions[self.offsets[group]:self.offsets[group + 1]]
+
+
+class OutputIndex:
+    """Lookup structures for querying an Output without scanning the record table
+
+    Holds name to row hash maps for the entity and attribute tables, the entity and attribute
+    table row of every record, per entity and per attribute posting lists of record rows, and
+    a datetime sorted order of the record table for range filters.
+    """
+
+    def __init__(self, entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame):
+        self.entity_names = entity['entity_name'].to_numpy()
+        self.attribute_names = attribute['attribute_name'].to_numpy()
+        self.entity_uuids = entity['entity_uuid'].astype(str).to_numpy()
+        self.attribute_uuids = attribute['attribute_uuid'].astype(str).to_numpy()
+
+        # Reversed so the first row wins for duplicate names, like a scan would
+        self.entity_by_name = {name: row for row, name in reversed(list(enumerate(self.entity_names)))}
+        self.attribute_by_name = {name: row for row, name in reversed(list(enumerate(self.attribute_names)))}
+        self.entity_by_uuid = {value: row for row, value in reversed(list(enumerate(self.entity_uuids)))}
+        self.attribute_by_uuid = {value: row for row, value in reversed(list(enumerate(self.attribute_uuids)))}
+
+        self.record_entity = _positions(record['entity_uuid'], entity['entity_uuid'])
+        self.record_attribute = _positions(record['attribute_uuid'], attribute['attribute_uuid'])
+
+        self.datetimes = _sort_keys(record['datetime'])
+        self.order = np.argsort(self.datetimes, kind='stable')
+        self.sorted_datetimes = self.datetimes[self.order]
+
+        self.entity_postings = Postings(self.record_entity, self.order, len(entity))
+        self.attribute_postings = Postings(self.record_attribute, self.order, len(attribute))
+
+    def extend(self, entity: pd.DataFrame, attribute: pd.DataFrame, record: pd.DataFrame) -> 'OutputIndex':
+        """Update the index in place for rows appended to the end of each table
+
+        The tables are the full tables after appending. Returns a rebuilt index instead when
+        the new datetimes cannot be merged with the existing ones.
+        """
+
+        start = len(self.datetimes)
+        new_record = record.iloc[start:]
+        datetimes = _sort_keys(new_record['datetime'])
+        if datetimes.dtype.kind != self.datetimes.dtype.kind:
+            return OutputIndex(entity, attribute, record)
+
+        self.entity_names, self.entity_uuids = self._extend_lookups(
+            entity, 'entity', self.entity_names, self.entity_uuids, self.entity_by_name, self.entity_by_uuid)
+        self.attribute_names, self.attribute_uuids = self._extend_lookups(
+            attribute, 'attribute', self.attribute_names, self.attribute_uuids, self.attribute_by_name,
+            self.attribute_by_uuid)
+
+        record_entity = _positions(new_record['entity_uuid'], entity['entity_uuid'])
+        record_attribute = _positions(new_record['attribute_uuid'], attribute['attribute_uuid'])
+        self.record_entity = np.concatenate([self.record_entity, record_entity])
+        self.record_attribute = np.concatenate([self.record_attribute, record_attribute])
+        self.datetimes = np.concatenate([self.datetimes, datetimes])
+
+        # Merge the sorted new rows into the datetime order
+        new_order = np.argsort(datetimes, kind='stable')
+        new_sorted = datetimes[new_order]
+        where = np.searchsorted(self.sorted_datetimes, new_sorted, side='right')
+        self.order = np.insert(self.order, where, new_order + start)
+        # Widen fixed width bytes first, as insert would truncate longer new values
+        self.sorted_datetimes = np.insert(self.sorted_datetimes.astype(self.datetimes.dtype), where, new_sorted)
+
+        rows = new_order + start
+        self.entity_postings.extend(record_entity[new_order], rows, self.datetimes, len(entity))
+        self.attribute_postings.extend(record_attribute[new_order], rows, self.datetimes, len(attribute))
+        return self
+
+    @staticmethod
+    def _extend_lookups(table: pd.DataFrame, kind: str, names: np.ndarray, uuids: np.ndarray, by_name: dict,
+                        by_uuid: dict):
+        new = table.iloc[len(names):]
+        new_names = new[f'{kind}_name'].to_numpy()
+        new_uuids = new[f'{kind}_uuid'].astype(str).to_numpy()
+        for row, (name, value) in enumerate(zip(new_names, new_uuids), len(names)):
+            by_name.setdefault(name, row)
+            by_uuid.setdefault(value, row)
+        return np.concatenate([names, new_names]), np.concatenate([uuids, new_uuids])
+
+    @staticmethod
+    def _cast(search_term: Any, names: np.ndarray):
+        # Match the type of the name column, as Output.get_entity_id does
+        if len(names) and type(search_term) is not type(names[0]):
+            return type(names[0])(search_term)
+        return search_term
+
+    def entity_rows(self, terms: Iterable) -> list:
+        """Entity table rows for entity names or UUIDs"""
+
+        return self._rows(terms, self.entity_by_name, self.entity_by_uuid, self.entity_names, 'entity')
+
+    def attribute_rows(self, terms: Iterable) -> list:
+        """Attribute table rows for attribute names or UUIDs"""
+
+        return self._rows(terms, self.attribute_by_name, self.attribute_by_uuid, self.attribute_names, 'attribute')
+
+    def _rows(self, terms, by_name, by_uuid, names, kind) -> list:
+        rows = []
+        for term in terms:
+            if isinstance(term, UUID):
+                row = by_uuid.get(str(term))
+            else:
+                row = by_name.get(self._cast(term, names))
+            if row is None:
+                raise ValueError(f"No {kind} found for search_term: {term}")
+            rows.append(row)
+        return rows
+
+    def _bound(self, value):
+        if self.datetimes.dtype.kind == 'S':
+            return str(value).encode()
+        if self.datetimes.dtype.kind == 'M':
+            return np.datetime64(pd.Timestamp(value))
+        return value
+
+    def _date_slice(self, sorted_datetimes: np.ndarray, after_date, before_date) -> slice:
+        start = 0 if after_date is None else np.searchsorted(sorted_datetimes, self._bound(after_date), side='right')
+        stop = len(sorted_datetimes)
+        if before_date is not None:
+            stop = np.searchsorted(sorted_datetimes, self._bound(before_date), side='left')
+        return slice(start, max(start, stop))
+
+    def _posting_rows(self, postings: Postings, groups: list, after_date, before_date) -> np.ndarray:
+        parts = []
+        for group in dict.fromkeys(groups):
+            rows = postings.get(group)
+            if after_date is not None or before_date is not None:
+                rows = rows[self._date_slice(self.datetimes[rows], after_date, before_date)]
+            parts.append(rows)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.intp)
+
+    def search(self, entities: Optional[list] = None, attributes: Optional[list] = None,
+               after_date=None, before_date=None) -> np.ndarray:
+        """Record rows, in table order, matching entity and attribute rows and a datetime range
+
+        Starts from the posting lists of the more selective filter, narrows them by binary
+        search on datetime, then checks the other filter on just those rows.
+        """
+
+        if entities is None and attributes is None:
+            rows = self.order[self._date_slice(self.sorted_datetimes, after_date, before_date)]
+        else:
+            entity_size = np.inf if entities is None else sum(self.entity_postings.size(g) for g in set(entities))
+            attribute_size = np.inf if attributes is None else sum(
+                self.attribute_postings.size(g) for g in set(attributes))
+
+            if entity_size <= attribute_size:
+                rows = self._posting_rows(self.entity_postings, entities, after_date, before_date)
+                if attributes is not None:
+                    rows = rows[np.isin(self.record_attribute[rows], attributes)]
+            else:
+                rows = self._posting_rows(self.attribute_postings, attributes, after_date, before_date)
+                if entities is not None:
+                    rows = rows[np.isin(self.record_entity[rows], entities)]
+
+        return np.sort(rows)
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+import pandas as pd
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger('hdata')
+
+STAGES = ['load', 'split', 'encode', 'upload', 'server_wait', 'download', 'decode', 'cache', 'accumulate',
+          'validate.columns', 'validate.entity', 'validate.attribute', 'validate.record', 'validate.uuid_match',
+          'append']
+
+
+class Span:
+    """Timing, byte count and row count of one stage, optionally for one source and chunk"""
+
+    __slots__ = ('stage', 'source', 'chunk', 'seconds', 'bytes', 'rows', 'error')
+
+    def __init__(self, stage: str, source: Optional[int] = None, chunk: Optional[int] = None, seconds: float = 0.0,
+                 bytes: int = 0, rows: int = 0):
+        self.stage = stage
+        self.source = source
+        self.chunk = chunk
+        self.seconds = seconds
+        self.bytes = bytes
+        self.rows = rows
+        self.error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Span({', '.join(f'{key}={value!r}' for key, value in self.as_dict().items())})"
+
+
+class Instrumentation:
+    """Collects structured per-stage timings for the transformation pipeline
+
+    Every span is logged to the 'hdata' logger at log_level, passed to each hook, and kept
+    in memory for summary when keep_spans is set. Pass an instance to transform to see where
+    a run spends its time.
+    """
+
+    def __init__(self, hooks: Iterable[Callable[[Span], None]] = (), keep_spans: bool = True,
+                 log_level: int = logging.DEBUG):
+        self.hooks: List[Callable[[Span], None]] = list(hooks)
+        self.keep_spans = keep_spans
+        self.log_level = log_level
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[Span], None]):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, stage: str, source: Optional[int] = None, chunk: Optional[int] = None, bytes: int = 0,
+             rows: int = 0) -> Iterator[Span]:
+        """Time the enclosed block; the yielded span's bytes and rows can be set inside it"""
+
+        span = Span(stage, source, chunk, bytes=bytes, rows=rows)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as error:
+            span.error = repr(error)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.emit(span)
+
+    def emit(self, span: Span):
+        if self.keep_spans:
+            with self._lock:
+                self.spans.append(span)
+        if logger.isEnabledFor(self.log_level):
+            logger.log(self.log_level, "%s source=%s chunk=%s seconds=%.6f bytes=%d rows=%d", span.stage, span.source,
+                       span.chunk, span.seconds, span.bytes, span.rows, extra={'hdata_span': span.as_dict()})
+        for hook in self.hooks:
+            hook(span)
+
+    def timed_iter(self, stage: str, iterable: Iterable, source: Optional[int] = None) -> Iterator:
+        """Yield from iterable, recording the time taken to produce each item as a span
+
+        Items with a length, such as DataFrame chunks, report it as their row count.
+        """
+
+        iterator = iter(iterable)
+        chunk = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            rows = len(item) if hasattr(item, '__len__') else 0
+            self.emit(Span(stage, source, chunk, seconds=time.perf_counter() - start, rows=rows))
+            yield item
+            chunk += 1
+
+    def summary(self) -> pd.DataFrame:
+        """Total, mean and max seconds, bytes and rows per stage, in pipeline order"""
+
+        with self._lock:
+            spans = pd.DataFrame([span.as_dict() for span in self.spans],
+                                 columns=['stage', 'source', 'chunk', 'seconds', 'bytes', 'rows', 'error'])
+        summary = spans.groupby('stage', sort=False).agg(
+            count=('seconds', 'size'), seconds=('seconds', 'sum'), mean_seconds=('seconds', 'mean'),
+            max_seconds=('seconds', 'max'), bytes=('bytes', 'sum'), rows=('rows', 'sum'),
+            errors=('error', 'count'))
+        order = [stage for stage in STAGES if stage in summary.index]
+        return summary.loc[order + [stage for stage in summary.index if stage not in STAGES]]
+
+    def report(self) -> str:
+        return self.summary().to_string()
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+NULL_INSTRUMENTATION = Instrumentation(keep_spans=False)
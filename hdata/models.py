@@ -1,45 +1,145 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import os
 import math
-import zipfile
-import io
-import base64
+import multiprocessing
+import threading
+import time
+import weakref
 from uuid import UUID
-from typing import Any
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
+from .chunking import ChunkSizer, rebatch
+from .force_validation import encode_uuids
+from .index import OutputIndex
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation, Span
+from .pool import ordered_map
+from .wire import OUTPUT_TABLES, check_wire_format, to_parquet_bytes, zip_payload
+
+
+SUPPORTED_EXTENSIONS = ['.csv', '.parquet', '.xlsx', '.json']
+SIZED_READ_ROWS = 10000
+RECORD_KEY = ['datetime', 'entity_uuid', 'attribute_uuid']
+# Scalar record value types that a mixed record_value column is saved as text for, and their parsers
+MIXED_VALUE_TYPES = (('bool', bool, lambda text: text == 'True'), ('int', int, int), ('float', float, float),
+                     ('str', str, str))
+
+
+def encode_chunk(chunk: pd.DataFrame, wire_format: str = 'json'):
+    """Encode a chunk for the transformation API
+
+    The json wire format is a base64 zipped parquet string. The binary wire format is raw
+    zstd compressed parquet bytes, sent as the request body.
+    """
+
+    check_wire_format(wire_format)
+    if wire_format == 'binary':
+        return to_parquet_bytes(chunk, compression='zstd')
+    return zip_payload(to_parquet_bytes(chunk))
 
-class Source:
-    """A class for loading data into the transformation pipeline"""
 
-    def __init__(self, transformation_key, data):
+def timed_encode_chunk(chunk: pd.DataFrame, wire_format: str = 'json'):
+    """Encode a chunk, also returning the seconds taken and the row count
+
+    Runs in encoding workers, which may be other processes, so the caller records the span.
+    """
+
+    start = time.perf_counter()
+    encoded = encode_chunk(chunk, wire_format)
+    return encoded, time.perf_counter() - start, len(chunk)
+
+
+class Source:
+    """A class for loading data into the transformation pipeline
+
+    Data is read, split and encoded lazily: iter_encoded_chunks streams one chunk at a time,
+    reading parquet row batches or csv chunks straight from disk, so peak memory stays
+    around a single chunk. data_frame, data_chunks and zipped_chunks are still available
+    and are materialized on first access.
+
+    With encode_workers > 1, chunks are encoded on a process pool (or a thread pool when
+    encode_processes is False) while earlier chunks are being sent, and are handed out in
+    order as each one finishes. The pool is started on first use and kept for later passes
+    and retries; call close to shut it down sooner than garbage collection would. Worker
+    processes are spawned rather than forked, as sources are encoded from threads.
+
+    Chunks hold max_rows_per_chunk rows unless target_chunk_bytes is set, in which case rows
+    per chunk are chosen so each encoded chunk is about that size. Pass a ChunkSizer instead
+    for finer control, including adaptive sizing from observed server latency. The source
+    keeps its own copy of it, calibrated to its own rows, so one sizer can configure many
+    sources.
+    """
+
+    def __init__(self, transformation_key, data, max_rows_per_chunk=30000, encode_workers=1, encode_processes=True,
+                 target_chunk_bytes=None, chunk_sizer=None):
         self.transformation_key: str = transformation_key
         self.data_input = data
-        self.data_frame = self.load_data()
-        self.data_chunks = self.split_data()
-        self.zipped_chunks = self.zip_chunks()
-
-    def load_data(self):
+        self.max_rows_per_chunk: int = max_rows_per_chunk
+        self.encode_workers: int = encode_workers
+        self.encode_processes: bool = encode_processes
+        if chunk_sizer is None and target_chunk_bytes is not None:
+            chunk_sizer = ChunkSizer(target_chunk_bytes)
+        self.chunk_sizer: Optional[ChunkSizer] = chunk_sizer.copy() if chunk_sizer is not None else None
+        self.file_extension = self.check_input()
+        self._data_frame = None
+        self._data_chunks = None
+        self._zipped_chunks = None
+        self._encode_pool = None
+        self._encode_pool_lock = threading.Lock()
+
+    def check_input(self):
         if isinstance(self.data_input, pd.DataFrame):
-            return self.data_input
+            return None
         elif isinstance(self.data_input, str):
             if os.path.exists(self.data_input):
                 file_extension = os.path.splitext(self.data_input)[1].lower()
-                if file_extension in ['.csv']:
-                    return pd.read_csv(self.data_input)
-                elif file_extension in ['.parquet']:
-                    return pd.read_parquet(self.data_input)
-                elif file_extension in ['.xlsx']:
-                    return pd.read_excel(self.data_input)
-                elif file_extension in ['.json']:
-                    return pd.read_json(self.data_input)
-                else:
+                if file_extension not in SUPPORTED_EXTENSIONS:
                     raise ValueError("Unsupported file format.")
+                return file_extension
             else:
                 raise FileNotFoundError("The specified file does not exist.")
         else:
             raise TypeError("Unsupported input type. Please provide a pandas DataFrame or a file path.")
 
-    def split_data(self, max_rows_per_chunk=30000):
+    @property
+    def data_frame(self) -> pd.DataFrame:
+        if self._data_frame is None:
+            self._data_frame = self.load_data()
+        return self._data_frame
+
+    @property
+    def data_chunks(self) -> List[pd.DataFrame]:
+        if self._data_chunks is None:
+            self._data_chunks = self.split_data()
+        return self._data_chunks
+
+    @property
+    def zipped_chunks(self) -> List[str]:
+        if self._zipped_chunks is None:
+            self._zipped_chunks = self.zip_chunks()
+        return self._zipped_chunks
+
+    def load_data(self):
+        if isinstance(self.data_input, pd.DataFrame):
+            return self.data_input
+        elif self.file_extension == '.csv':
+            return pd.read_csv(self.data_input)
+        elif self.file_extension == '.parquet':
+            return pd.read_parquet(self.data_input)
+        elif self.file_extension == '.xlsx':
+            return pd.read_excel(self.data_input)
+        elif self.file_extension == '.json':
+            return pd.read_json(self.data_input)
+
+    def split_data(self, max_rows_per_chunk=None):
+        if max_rows_per_chunk is None and self.chunk_sizer is not None:
+            return list(self._sized_chunks('json'))
+        max_rows_per_chunk = max_rows_per_chunk or self.max_rows_per_chunk
         rows = self.data_frame.shape[0]
         if rows > max_rows_per_chunk:
             num_chunks = math.ceil(rows / max_rows_per_chunk)
@@ -48,27 +148,347 @@ class Source:
             return [self.data_frame]
 
     def zip_chunks(self):
-        encoded_zips = []
+        return list(self.encode_chunks(self.data_chunks))
+
+    def iter_chunks(self, instrumentation: Instrumentation = None, source_index: int = None,
+                    wire_format: str = 'json') -> Iterator[pd.DataFrame]:
+        """Yield the source data in chunks of at most max_rows_per_chunk rows, or sized by chunk_sizer
+
+        With a chunk_sizer, its bytes per row estimate is calibrated by encoding a sample of
+        the first rows in wire_format.
+        """
+
+        instrumentation = instrumentation or NULL_INSTRUMENTATION
+        stage = 'split' if isinstance(self.data_input, pd.DataFrame) else 'load'
+        chunks = self._read_chunks() if self.chunk_sizer is None else self._sized_chunks(wire_format)
+        yield from instrumentation.timed_iter(stage, chunks, source_index)
+
+    def _read_chunks(self, rows: int = None) -> Iterator[pd.DataFrame]:
+        rows = rows or self.max_rows_per_chunk
+        if self._data_chunks is not None:
+            yield from self._data_chunks
+        elif self._data_frame is not None or self.file_extension not in ['.csv', '.parquet']:
+            yield from self.split_data(rows)
+        elif self.file_extension == '.parquet':
+            parquet_file = pq.ParquetFile(self.data_input)
+            for batch in parquet_file.iter_batches(batch_size=rows):
+                yield batch.to_pandas()
+        else:
+            with pd.read_csv(self.data_input, chunksize=rows) as reader:
+                yield from reader
+
+    def _sized_chunks(self, wire_format: str) -> Iterator[pd.DataFrame]:
+        if self._data_chunks is not None:
+            yield from self._data_chunks
+            return
+        sizer = self.chunk_sizer
+        if self._data_frame is not None or self.file_extension not in ['.csv', '.parquet']:
+            # In memory data is sliced directly, sizing each chunk as it is taken
+            frame = self.data_frame
+            sizer.calibrate(frame, partial(encode_chunk, wire_format=wire_format))
+            start = 0
+            while start < len(frame):
+                rows = sizer.rows()
+                yield frame.iloc[start:start + rows]
+                start += rows
+            return
+
+        def blocks():
+            for block in self._read_chunks(SIZED_READ_ROWS):
+                sizer.calibrate(block, partial(encode_chunk, wire_format=wire_format))
+                yield block
+
+        yield from rebatch(blocks(), sizer.rows)
+
+    def iter_encoded_chunks(self, wire_format: str = 'json', instrumentation: Instrumentation = None,
+                            source_index: int = None) -> Iterator[Union[str, bytes]]:
+        """Yield encoded chunks ready to send, encoding each one on demand"""
+
+        check_wire_format(wire_format)
+        if self._zipped_chunks is not None and wire_format == 'json':
+            yield from self._zipped_chunks
+            return
+
+        chunks = self.iter_chunks(instrumentation, source_index, wire_format)
+        yield from self.encode_chunks(chunks, wire_format, instrumentation, source_index)
+
+    def encode_chunks(self, chunks: Iterable[pd.DataFrame], wire_format: str = 'json',
+                      instrumentation: Instrumentation = None, source_index: int = None) -> Iterator[Union[str, bytes]]:
+        """Encode chunks in order, on a pool of encode_workers when there is more than one"""
+
+        instrumentation = instrumentation or NULL_INSTRUMENTATION
+        encode = partial(timed_encode_chunk, wire_format=wire_format)
+        executor = None
+        if self.encode_workers <= 1:
+            results = map(encode, chunks)
+        else:
+            executor = self._encode_executor()
+            # Keep a second batch queued so workers stay busy while results are consumed
+            results = ordered_map(encode, chunks, executor, 2 * self.encode_workers)
+
+        try:
+            for index, (encoded, seconds, rows) in enumerate(results):
+                instrumentation.emit(Span('encode', source_index, index, seconds, len(encoded), rows))
+                if self.chunk_sizer is not None:
+                    self.chunk_sizer.observe_encoded(len(encoded), rows)
+                yield encoded
+        finally:
+            if executor is not None:
+                results.close()
+
+    def _encode_executor(self):
+        """The pool of encode_workers, started on first use"""
+
+        with self._encode_pool_lock:
+            if self._encode_pool is None:
+                if self.encode_processes:
+                    # Forking a process whose other threads hold locks can deadlock the child
+                    self._encode_pool = ProcessPoolExecutor(max_workers=self.encode_workers,
+                                                            mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._encode_pool = ThreadPoolExecutor(max_workers=self.encode_workers)
+                weakref.finalize(self, self._encode_pool.shutdown, wait=False, cancel_futures=True)
+            return self._encode_pool
+
+    def close(self):
+        """Shut down the encoding pool, if one was started"""
+
+        with self._encode_pool_lock:
+            if self._encode_pool is not None:
+                self._encode_pool.shutdown(wait=True, cancel_futures=True)
+                self._encode_pool = None
+
+
+class RecordMatrix(NamedTuple):
+    """A pivoted record table: values[entity, attribute], or values[bucket, entity, attribute]
+
+    entities and attributes hold the entity and attribute UUIDs labelling the two axes.
+    """
+
+    values: Any
+    entities: np.ndarray
+    attributes: np.ndarray
+    buckets: Optional[pd.PeriodIndex] = None
+
+
+def record_to_arrow(record: pd.DataFrame) -> pa.Table:
+    """Convert a record table to Arrow, keeping a record_value column of mixed types
+
+    Arrow columns hold one type, so a record_value column mixing str, int, float and bool
+    values is stored as text next to a record_value_type column naming each value's type.
+    Mixes that include lists or bytes raise ValueError.
+    """
+
+    try:
+        return pa.Table.from_pandas(record, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        values = record['record_value'].to_numpy(dtype=object)
+
+    kinds = []
+    for value in values:
+        kind = None
+        if value is not None:
+            kind = next((name for name, value_type, _ in MIXED_VALUE_TYPES if isinstance(value, value_type)), None)
+            if kind is None:
+                raise ValueError(f"record_value mixes {type(value).__name__} values with other types, which cannot "
+                                 "be saved to one Arrow column. Cast record_value to a single type first.")
+        kinds.append(kind)
 
-        for chunk in self.data_chunks:
-            parquet_buffer = io.BytesIO()
-            chunk.to_parquet(parquet_buffer, index=False)
-            parquet_buffer.seek(0)
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.writestr(f"source.parquet", parquet_buffer.getvalue())
-            zip_buffer.seek(0)
-            encoded_zip = base64.b64encode(zip_buffer.read()).decode('utf-8')
-            encoded_zips.append(encoded_zip)
+    table = pa.Table.from_pandas(record.drop(columns='record_value'), preserve_index=False)
+    text = pa.array([None if value is None else str(value) for value in values], pa.large_string())
+    table = table.add_column(record.columns.get_loc('record_value'), 'record_value', text)
+    return table.append_column('record_value_type', pa.array(kinds, pa.string()).dictionary_encode())
 
-        return encoded_zips
+
+def restore_record_values(record: pd.DataFrame) -> pd.DataFrame:
+    """Parse a record_value column stored as text by record_to_arrow back into its types"""
+
+    if 'record_value_type' not in record:
+        return record
+    parsers = {name: parse for name, _, parse in MIXED_VALUE_TYPES}
+    kinds = record['record_value_type'].astype(object)
+    values = [None if pd.isna(kind) else parsers[kind](value) for kind, value in zip(kinds, record['record_value'])]
+    values = pd.Series(values, index=record.index, dtype=object)
+    return record.drop(columns='record_value_type').assign(record_value=values)
 
 
 class Output:
+    """The entity, attribute and record tables produced by a transformation
+
+    Queries run against an OutputIndex that is built on first use, and batch profiles are
+    cached. Call invalidate after modifying the tables in place so both are rebuilt.
+    """
+
     def __init__(self, entity, attribute, record):
         self.entity: pd.DataFrame = entity
         self.attribute: pd.DataFrame = attribute
         self.record: pd.DataFrame = record
+        self._index: Optional[OutputIndex] = None
+        self._cache: dict = {}
+        self._keys: Optional[np.ndarray] = None
+        self._key_rows: Optional[np.ndarray] = None
+        # Job and outcome of each source, set by transform
+        self.job_uuid: Optional[str] = None
+        self.source_status: list = []
+
+    @property
+    def index(self) -> OutputIndex:
+        if self._index is None:
+            self._index = OutputIndex(self.entity, self.attribute, self.record)
+        return self._index
+
+    def invalidate(self):
+        """Drop cached indexes and profiles so they are rebuilt from the current tables"""
+
+        self._index = None
+        self._cache = {}
+        self._keys = None
+        self._key_rows = None
+
+    @staticmethod
+    def _hash_keys(record: pd.DataFrame) -> np.ndarray:
+        return pd.util.hash_pandas_object(record[RECORD_KEY], index=False).to_numpy()
+
+    def _record_keys(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted 64 bit hashes of the datetime, entity_uuid and attribute_uuid of every record,
+        and the record row of each hash"""
+
+        if self._keys is None:
+            hashes = self._hash_keys(self.record)
+            self._key_rows = np.argsort(hashes, kind='stable')
+            self._keys = hashes[self._key_rows]
+        return self._keys, self._key_rows
+
+    @staticmethod
+    def _new_rows(table: pd.DataFrame, existing: pd.DataFrame, kind: str) -> pd.DataFrame:
+        """Rows of table whose UUID is not in existing, checking names against existing rows"""
+
+        uuid_column, name_column = f'{kind}_uuid', f'{kind}_name'
+        positions = pd.Index(existing[uuid_column].astype(str)).get_indexer(table[uuid_column].astype(str))
+        known = positions >= 0
+
+        existing_names = existing[name_column].to_numpy(dtype=object)[positions[known]]
+        renamed = existing_names != table[name_column].to_numpy(dtype=object)[known]
+        if renamed.any():
+            raise ValueError(f"{uuid_column} already exists with a different {name_column}: "
+                             f"{table[uuid_column][known][renamed].tolist()}")
+
+        new = table[~known]
+        collisions = new[name_column].isin(existing[name_column].to_numpy(dtype=object))
+        if collisions.any():
+            raise ValueError(f"{name_column} already exists with a different {uuid_column}: "
+                             f"{new[name_column][collisions].tolist()}")
+        return new
+
+    def append(self, other: 'Output', instrumentation: Instrumentation = None) -> 'Output':
+        """Add the tables of another validated Output, such as a transform of newly arrived data
+
+        Only the new rows are validated against the existing tables: entities and attributes
+        that are already present with the same UUID and name are shared, a known UUID with a
+        different name or a known name with a different UUID raises ValueError, and a record
+        whose datetime, entity and attribute are already present raises, as in validation.
+        Records are checked against a sorted array of key hashes and their rows, kept between
+        appends, so only stored rows sharing a hash with a new record are compared.
+
+        The index, if built, is updated in place and cached profiles are dropped. Returns self.
+        """
+
+        instrumentation = instrumentation or NULL_INSTRUMENTATION
+        with instrumentation.span('append', rows=len(other.record)):
+            entity = self._new_rows(other.entity, self.entity, 'entity')
+            attribute = self._new_rows(other.attribute, self.attribute, 'attribute')
+            entity = pd.concat([self.entity, entity], ignore_index=True)
+            attribute = pd.concat([self.attribute, attribute], ignore_index=True)
+
+            record = other.record.reset_index(drop=True)
+            if record.duplicated(subset=RECORD_KEY).any():
+                raise Exception(
+                    "There can be no duplicate combinations of datetime, entity_uuid, and attribute_uuid.")
+            keys, key_rows = self._record_keys()
+            hashes = self._hash_keys(record)
+            start = np.searchsorted(keys, hashes, side='left')
+            stop = np.searchsorted(keys, hashes, side='right')
+            candidates = stop > start
+            if candidates.any():
+                # Confirm hash matches against the stored rows with those hashes before rejecting the batch
+                counts = (stop - start)[candidates]
+                offsets = np.repeat(start[candidates] - np.cumsum(counts) + counts, counts)
+                rows = key_rows[offsets + np.arange(counts.sum())]
+                matches = self.record.iloc[rows][RECORD_KEY]
+                if len(record[candidates][RECORD_KEY].astype(str).merge(matches.astype(str))):
+                    raise Exception(
+                        "There can be no duplicate combinations of datetime, entity_uuid, and attribute_uuid.")
+
+            # Put old and new rows on the same categories: the appended table UUIDs
+            columns = {}
+            for column, table in [('entity_uuid', entity), ('attribute_uuid', attribute)]:
+                existing = encode_uuids(self.record[column], table[column])
+                new = encode_uuids(record[column], table[column])
+                if new.isnull().any():
+                    raise ValueError(f"All {column}s in the record table must exist in the {column[:-5]} table.")
+                columns[column] = (existing, new)
+            old_record = self.record.assign(**{column: values[0] for column, values in columns.items()})
+            record = record.assign(**{column: values[1] for column, values in columns.items()})
+
+            self.entity, self.attribute = entity, attribute
+            new_rows = np.argsort(hashes, kind='stable')
+            positions = np.searchsorted(keys, hashes[new_rows])
+            self._keys = np.insert(keys, positions, hashes[new_rows])
+            self._key_rows = np.insert(key_rows, positions, new_rows + len(self.record))
+            self.record = pd.concat([old_record, record], ignore_index=True)
+            if self._index is not None:
+                self._index = self._index.extend(self.entity, self.attribute, self.record)
+            self._cache = {}
+        return self
+
+    def to_arrow(self) -> dict:
+        """The entity, attribute and record tables as Arrow tables
+
+        Categorical UUID columns become dictionary arrays. A record_value column of mixed
+        types is stored as text with a record_value_type column, see record_to_arrow.
+        """
+
+        tables = {name: pa.Table.from_pandas(getattr(self, name), preserve_index=False) for name in OUTPUT_TABLES[:2]}
+        tables['record'] = record_to_arrow(self.record)
+        return tables
+
+    @classmethod
+    def from_arrow(cls, entity: pa.Table, attribute: pa.Table, record: pa.Table) -> 'Output':
+        """Wrap Arrow tables without copying their data
+
+        Columns are exposed as pandas ArrowDtype columns over the Arrow buffers. Dictionary
+        columns become categoricals, which copies only their small integer codes.
+        """
+
+        def types_mapper(arrow_type):
+            return None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type)
+
+        frames = [table.to_pandas(types_mapper=types_mapper) for table in (entity, attribute, record)]
+        frames[2] = restore_record_values(frames[2])
+        return cls(*frames)
+
+    def save(self, path: str):
+        """Save the tables as uncompressed Arrow IPC (Feather v2) files in the directory path"""
+
+        os.makedirs(path, exist_ok=True)
+        for name, table in self.to_arrow().items():
+            feather.write_feather(table, os.path.join(path, f"{name}.arrow"), compression='uncompressed')
+
+    @classmethod
+    def load(cls, path: str, memory_map: bool = True) -> 'Output':
+        """Load an Output saved with save
+
+        With memory_map, the files are mapped rather than read, so opening is near instant,
+        pages are only read when touched, and processes opening the same files share one copy
+        in the page cache.
+        """
+
+        tables = []
+        for name in OUTPUT_TABLES:
+            file_path = os.path.join(path, f"{name}.arrow")
+            source = pa.memory_map(file_path) if memory_map else pa.OSFile(file_path)
+            tables.append(pa.ipc.open_file(source).read_all())
+        return cls.from_arrow(*tables)
 
     def get_entity_id(self, search_term: Any, entity_table: pd.DataFrame):
         # type cast search term to match the column type
@@ -114,19 +534,195 @@ class Output:
 
         values = value_table[value_table['attribute_uuid'] == str(attribute_id)]
 
-        attribute_entity_ids = values['entity_uuid'].unique()
         # Get all entities which have this attribute
-        entity_ids = []
-        for entity in entity_table.itertuples():
-            if entity.entity_uuid in attribute_entity_ids:
-                entity_ids.append(entity)
-
-        entities = pd.DataFrame(entity_ids)
+        entities = entity_table[entity_table['entity_uuid'].isin(values['entity_uuid'].unique())]
 
         values_and_entities = pd.merge(left=entities, right=values, on=['entity_uuid'])
 
         return values_and_entities[['entity_name', 'record_value']]
 
+    def _profile_order(self, kind: str):
+        """Record rows sorted by entity then attribute (or the reverse), with per-group offsets
+
+        Built in one pass over the record table and cached, so each profile afterwards is a
+        slice.
+        """
+
+        key = f"{kind}_profile"
+        if key not in self._cache:
+            index = self.index
+            if kind == 'entity':
+                primary, secondary, groups = index.record_entity, index.record_attribute, len(self.entity)
+            else:
+                primary, secondary, groups = index.record_attribute, index.record_entity, len(self.attribute)
+            rows = np.flatnonzero((primary >= 0) & (secondary >= 0))
+            rows = rows[np.lexsort((secondary[rows], primary[rows]))]
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(primary[rows], minlength=groups))])
+            self._cache[key] = (rows, offsets)
+        return self._cache[key]
+
+    def _latest_rows(self, buckets: Optional[np.ndarray] = None) -> np.ndarray:
+        """For each entity and attribute pair, the record row with the latest datetime
+
+        With buckets, an integer bucket per record row, the latest row is found for each
+        bucket, entity and attribute instead.
+        """
+
+        if buckets is None and 'latest_rows' in self._cache:
+            return self._cache['latest_rows']
+
+        index = self.index
+        rows = np.flatnonzero((index.record_entity >= 0) & (index.record_attribute >= 0))
+        keys = index.record_entity[rows].astype(np.int64) * len(self.attribute) + index.record_attribute[rows]
+        if buckets is not None:
+            keys += buckets[rows].astype(np.int64) * len(self.entity) * len(self.attribute)
+        order = np.lexsort((index.datetimes[rows], keys))
+        rows, keys = rows[order], keys[order]
+        latest = rows[np.append(keys[1:] != keys[:-1], True)]
+
+        if buckets is None:
+            self._cache['latest_rows'] = latest
+        return latest
+
+    def _buckets(self, freq: str):
+        """Period bucket codes of every record row and the sorted bucket labels
+
+        Only the distinct datetime strings are parsed.
+        """
+
+        codes, uniques = pd.factorize(self.record['datetime'])
+        periods = pd.to_datetime(pd.Series(uniques), format='mixed').dt.to_period(freq)
+        bucket_codes, labels = pd.factorize(periods, sort=True)
+        return bucket_codes[codes], pd.PeriodIndex(labels)
+
+    def to_matrix(self, freq: Optional[str] = None, sparse: bool = False) -> RecordMatrix:
+        """Pivot the record table into an entity by attribute matrix of the latest values
+
+        Rows follow the entity table and columns the attribute table. With freq, a pandas
+        period alias such as 'D', 'M' or 'Y', records are bucketed by period and the latest
+        value in each bucket is kept, giving a (buckets, entities, attributes) array. Missing
+        pairs are NaN in the dense array and absent from the sparse one. sparse returns
+        scipy.sparse CSR matrices, one per bucket when freq is given, and needs numeric values.
+
+        Results are cached until invalidate is called.
+        """
+
+        key = ('matrix', freq, sparse)
+        if key in self._cache:
+            return self._cache[key]
+
+        index = self.index
+        buckets, labels = self._buckets(freq) if freq is not None else (None, None)
+        rows = self._latest_rows(buckets)
+        entity_rows = index.record_entity[rows]
+        attribute_rows = index.record_attribute[rows]
+        bucket_rows = buckets[rows] if buckets is not None else np.zeros(len(rows), dtype=np.intp)
+        values = self.record['record_value'].take(rows).to_numpy()
+        shape = (1 if labels is None else len(labels), len(self.entity), len(self.attribute))
+
+        if sparse:
+            try:
+                from scipy.sparse import csr_matrix
+            except ImportError:
+                raise ImportError("to_matrix(sparse=True) requires scipy. Install it with: pip install scipy")
+            if values.dtype.kind not in 'biuf':
+                raise TypeError("Sparse matrices need numeric record values.")
+            matrices = []
+            for bucket in range(shape[0]):
+                selected = bucket_rows == bucket
+                matrices.append(csr_matrix((values[selected], (entity_rows[selected], attribute_rows[selected])),
+                                           shape=shape[1:]))
+            matrix = matrices[0] if labels is None else matrices
+        else:
+            dtype = values.dtype if values.dtype.kind in 'fc' else (
+                np.float64 if values.dtype.kind in 'biu' else object)
+            matrix = np.full(shape, np.nan, dtype=dtype)
+            matrix[bucket_rows, entity_rows, attribute_rows] = values
+            if labels is None:
+                matrix = matrix[0]
+
+        result = RecordMatrix(matrix, index.entity_uuids, index.attribute_uuids, labels)
+        self._cache[key] = result
+        return result
+
+    def _latest_wide(self) -> pd.DataFrame:
+        """Entity by attribute table of the latest record value of every pair, cached"""
+
+        if 'latest_wide' not in self._cache:
+            matrix = self.to_matrix()
+            self._cache['latest_wide'] = pd.DataFrame(
+                matrix.values, index=pd.Index(matrix.entities, name='entity_uuid'),
+                columns=pd.Index(self.index.attribute_names, name='attribute_name'))
+        return self._cache['latest_wide']
+
+    def _uuid_positions(self, ids: Optional[List[str]], by_uuid: dict, label: str) -> Optional[List[int]]:
+        if ids is None:
+            return None
+        positions = []
+        for value in ids:
+            try:
+                uuid = str(UUID(str(value)))
+            except ValueError:
+                raise ValueError(f"{label} must be a valid UUID")
+            if uuid not in by_uuid:
+                raise ValueError(f"No {label.split()[0].lower()} found for UUID: {uuid}")
+            positions.append(by_uuid[uuid])
+        return positions
+
+    def describe_entities(self, entity_ids: Optional[List[str]] = None, wide: bool = False) -> pd.DataFrame:
+        """Profiles of many entities at once
+
+        Returns entity_uuid, attribute_name, datetime and record_value for every record of the
+        given entities (all entities by default), ordered by entity and attribute. With wide,
+        returns an entity by attribute table of the latest value of each attribute instead.
+        """
+
+        index = self.index
+        positions = self._uuid_positions(entity_ids, index.entity_by_uuid, 'Entity ID')
+
+        if wide:
+            table = self._latest_wide()
+            return table if positions is None else table.iloc[positions]
+
+        rows, offsets = self._profile_order('entity')
+        if positions is not None:
+            rows = np.concatenate([rows[offsets[p]:offsets[p + 1]] for p in positions] or [rows[:0]])
+
+        return pd.DataFrame({
+            'entity_uuid': index.entity_uuids[index.record_entity[rows]],
+            'attribute_name': index.attribute_names[index.record_attribute[rows]],
+            'datetime': self.record['datetime'].take(rows).to_numpy(),
+            'record_value': self.record['record_value'].take(rows).to_numpy(),
+        })
+
+    def describe_attributes(self, attribute_ids: Optional[List[str]] = None, wide: bool = False) -> pd.DataFrame:
+        """Profiles of many attributes at once
+
+        Returns attribute_uuid, entity_name, datetime and record_value for every record of the
+        given attributes (all attributes by default), ordered by attribute and entity. With
+        wide, returns an attribute by entity table of the latest value for each entity instead.
+        """
+
+        index = self.index
+        positions = self._uuid_positions(attribute_ids, index.attribute_by_uuid, 'Attribute ID')
+
+        if wide:
+            table = self._latest_wide().T
+            table.index = pd.Index(index.attribute_uuids, name='attribute_uuid')
+            table.columns = pd.Index(index.entity_names, name='entity_name')
+            return table if positions is None else table.iloc[positions]
+
+        rows, offsets = self._profile_order('attribute')
+        if positions is not None:
+            rows = np.concatenate([rows[offsets[p]:offsets[p + 1]] for p in positions] or [rows[:0]])
+
+        return pd.DataFrame({
+            'attribute_uuid': index.attribute_uuids[index.record_attribute[rows]],
+            'entity_name': index.entity_names[index.record_entity[rows]],
+            'datetime': self.record['datetime'].take(rows).to_numpy(),
+            'record_value': self.record['record_value'].take(rows).to_numpy(),
+        })
+
     def query(self, **kwargs):
 
         # Return all entities, attributes or records
@@ -138,48 +734,30 @@ class Output:
             if kwargs['all'] == 'record':
                 return self.record[['record_value']]
 
-        # Narrow down query
-        filters = []
+        # Narrow down query with the lazily built indexes
+        index = self.index
+        entities = None
+        attributes = None
 
         if 'entity' in kwargs:
-            if type(kwargs['entity']) == str:
-                entity_id = self.get_entity_id(kwargs['entity'], self.entity)
-                filters.append((self.record['entity_uuid'] == entity_id))
-            if type(kwargs['entity']) == UUID:
-                filters.append((self.record['entity_uuid'] == kwargs['entity']))
-            if type(kwargs['entity']) == list:
-                entity_ids = []
-                for entity_name in kwargs['entity']:
-                    entity_id = self.get_entity_id(entity_name, self.entity)
-                    entity_ids.append(entity_id)
-                filters.append((self.record['entity_uuid'].isin(entity_ids)))
+            terms = kwargs['entity'] if isinstance(kwargs['entity'], list) else [kwargs['entity']]
+            entities = index.entity_rows(terms)
 
         if 'attribute' in kwargs:
-            if type(kwargs['attribute']) == str:
-                attribute_id = self.get_attribute_id(kwargs['attribute'], self.attribute)
-                filters.append((self.record['attribute_uuid'] == attribute_id))
-            if type(kwargs['attribute']) == UUID:
-                filters.append((self.record['attribute_uuid'] == kwargs['attribute']))
-            if type(kwargs['attribute']) == list:
-                attribute_ids = []
-                for attribute_name in kwargs['attribute']:
-                    attribute_id = self.get_attribute_id(attribute_name, self.attribute)
-                    attribute_ids.append(attribute_id)
-                filters.append((self.record['attribute_uuid'].isin(attribute_ids)))
-
-        if 'after_date' in kwargs:
-            filters.append((self.record['datetime'] > kwargs['after_date']))
-
-        if 'before_date' in kwargs:
-            filters.append((self.record['datetime'] < kwargs['before_date']))
-
-        # Combine all filters using logical AND
-        if filters:
-            combined_filters = filters[0]
-            for f in filters[1:]:
-                combined_filters &= f
-            df_filt = self.record[combined_filters]
-        else:
-            df_filt = self.record
-
-        return df_filt.merge(self.entity, on=['entity_uuid']).merge(self.attribute, on=['attribute_uuid'])[['datetime', 'entity_name', 'attribute_name', 'record_value']]
+            terms = kwargs['attribute'] if isinstance(kwargs['attribute'], list) else [kwargs['attribute']]
+            attributes = index.attribute_rows(terms)
+
+        rows = index.search(entities, attributes, kwargs.get('after_date'), kwargs.get('before_date'))
+
+        # Resolve names by position, keeping only records whose entity and attribute exist
+        entity_rows = index.record_entity[rows]
+        attribute_rows = index.record_attribute[rows]
+        found = (entity_rows >= 0) & (attribute_rows >= 0)
+        rows, entity_rows, attribute_rows = rows[found], entity_rows[found], attribute_rows[found]
+
+        return pd.DataFrame({
+            'datetime': self.record['datetime'].take(rows).to_numpy(),
+            'entity_name': self.entity['entity_name'].take(entity_rows).to_numpy(),
+            'attribute_name': self.attribute['attribute_name'].take(attribute_rows).to_numpy(),
+            'record_value': self.record['record_value'].take(rows).to_numpy(),
+        })
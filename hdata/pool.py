@@ -0,0 +1,58 @@
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, Optional
+
+_DONE = object()
+
+
+def ordered_map(fn: Callable, iterable: Iterable, executor: Executor, max_in_flight: int,
+                limit: Optional[threading.Semaphore] = None) -> Iterator:
+    """Map fn over iterable on an executor, keeping at most max_in_flight calls pending.
+
+    Results are yielded in input order. The iterable is consumed lazily, so a new item
+    is only pulled once a slot is free. With limit, a slot of that semaphore is also taken
+    before each item is pulled and freed once its call is done or cancelled, so maps
+    sharing one semaphore hold at most its value of items between them.
+    """
+
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1.")
+
+    pending = deque()
+    items = iter(iterable)
+
+    try:
+        while True:
+            item = _next(items, limit)
+            if item is _DONE:
+                break
+            future = executor.submit(fn, item)
+            if limit is not None:
+                future.add_done_callback(lambda _: limit.release())
+            pending.append(future)
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Drop work that has not started yet if the consumer stops early
+        for future in pending:
+            future.cancel()
+
+
+def _next(items: Iterator, limit: Optional[threading.Semaphore]):
+    """The next item, taking a slot of limit for it first, or _DONE"""
+
+    if limit is None:
+        return next(items, _DONE)
+    limit.acquire()
+    try:
+        item = next(items, _DONE)
+    except BaseException:
+        limit.release()
+        raise
+    if item is _DONE:
+        limit.release()
+    return item
@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BASE_URL = 'https://api.hyperdata.so'
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for throttled or failed requests"""
+
+    def __init__(self, total: int = 5, backoff_factor: float = 1.0, backoff_max: float = 60.0, jitter: float = 0.5,
+                 status_forcelist=(429, 500, 502, 503, 504), respect_retry_after: bool = True):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.status_forcelist = frozenset(status_forcelist)
+        self.respect_retry_after = respect_retry_after
+
+    def is_retryable(self, response: requests.Response) -> bool:
+        return response.status_code in self.status_forcelist
+
+    def retry_after(self, response: Optional[requests.Response]) -> Optional[float]:
+        """Parse the Retry-After header as seconds or an HTTP date"""
+
+        if response is None or not self.respect_retry_after:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Seconds to wait before retry number attempt (starting at 0)"""
+
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        backoff = min(self.backoff_max, self.backoff_factor * (2 ** attempt))
+        return backoff * (1 - self.jitter * random.random())
+
+
+class Transport:
+    """Pooled HTTP transport for the HyperData API
+
+    Holds a keep-alive requests.Session shared by every call, applies a default timeout and
+    retries throttled (429) and server (5xx) responses and connection errors with the
+    retry policy. Point base_url at a local server to stand in for the API.
+
+    pool_maxsize is the number of connections kept alive per host; size it to at least the
+    number of concurrent requests, or connections beyond it are discarded after each use.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, timeout=(10, 300), retry: Optional[RetryPolicy] = None,
+                 pool_connections: int = 10, pool_maxsize: int = 10, session: Optional[requests.Session] = None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.session = session if session is not None else requests.Session()
+        self.sleep = time.sleep
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._pool_lock = threading.Lock()
+        self._mount()
+
+    def _mount(self):
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def ensure_pool_size(self, size: int):
+        """Grow the connection pool to keep at least size connections alive per host"""
+
+        with self._pool_lock:
+            if size > self.pool_maxsize:
+                self.pool_maxsize = size
+                self._mount()
+
+    def url(self, path: str) -> str:
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return self.base_url + '/' + path.lstrip('/')
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Send a request, retrying according to the retry policy
+
+        The last response is returned once retries are exhausted, so callers still see the
+        failing status code. Connection errors and timeouts are raised after the last attempt.
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url(path)
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retry.total:
+                    raise
+                self.sleep(self.retry.delay(attempt))
+                attempt += 1
+                continue
+
+            if not self.retry.is_retryable(response) or attempt >= self.retry.total:
+                return response
+
+            delay = self.retry.delay(attempt, response)
+            response.close()
+            self.sleep(delay)
+            attempt += 1
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_default_transport: Optional[Transport] = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport() -> Transport:
+    """Return the process-wide transport, creating it on first use"""
+
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
+
+
+def set_default_transport(transport: Optional[Transport]):
+    """Replace the process-wide transport, e.g. to target a local stub server"""
+
+    global _default_transport
+    with _default_transport_lock:
+        _default_transport = transport
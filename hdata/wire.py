@@ -0,0 +1,295 @@
+import base64
+import binascii
+import io
+import re
+import zipfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+WIRE_FORMATS = ('json', 'binary')
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+MULTIPART_CONTENT_TYPE = 'multipart/mixed'
+OUTPUT_TABLES = ('entity', 'attribute', 'record')
+WHITESPACE = b' \t\r\n'
+
+
+def check_wire_format(wire_format: str):
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError(f"Unknown wire format: {wire_format}. Use one of {WIRE_FORMATS}.")
+
+
+def to_parquet_bytes(chunk: pd.DataFrame, compression: str = 'snappy') -> bytes:
+    buffer = io.BytesIO()
+    chunk.to_parquet(buffer, index=False, compression=compression)
+    return buffer.getvalue()
+
+
+def zip_payload(parquet_bytes: bytes) -> str:
+    """Wrap parquet bytes in a zip archive and base64 encode it for the JSON wire format
+
+    The zip entry has a fixed timestamp so identical chunks always encode to identical
+    strings, which lets the chunk cache recognise them across runs.
+    """
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        entry = zipfile.ZipInfo("source.parquet", date_time=(1980, 1, 1, 0, 0, 0))
+        entry.compress_type = zipfile.ZIP_DEFLATED
+        zipf.writestr(entry, parquet_bytes)
+    return base64.b64encode(zip_buffer.getvalue()).decode('utf-8')
+
+
+def read_parquet_bytes(data, as_arrow: bool = False) -> Union[pd.DataFrame, pa.Table]:
+    """Read a parquet file held in memory without copying it into a BytesIO
+
+    With as_arrow the Arrow table is returned, which holds the data as record batches
+    without converting it to pandas.
+    """
+
+    table = pq.read_table(pa.BufferReader(data))
+    return table if as_arrow else table.to_pandas()
+
+
+def _decode_tables(bodies: Iterable[Tuple[str, bytes]], record_as_arrow: bool = False) -> dict:
+    # Each table is decoded as soon as its bytes are complete, then its bytes are dropped
+    return {name: read_parquet_bytes(body, record_as_arrow and name == 'record') for name, body in bodies}
+
+
+class JSONTableReader:
+    """Incremental parser for a JSON object of base64 encoded tables
+
+    Feed it the response body as it arrives. The base64 string of each key in names is
+    decoded as it streams in, and each table's bytes are returned as a (name, body) pair as
+    soon as its closing quote has been read, so the JSON text is never held in full. Values
+    of other keys are skipped.
+    """
+
+    def __init__(self, names: Iterable[str] = OUTPUT_TABLES):
+        self.names = set(names)
+        self.buffer = bytearray()
+        self.state = 'start'
+        self.key = bytearray()
+        self.body: Optional[bytearray] = None
+        self.pending = b''
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.finished = False
+
+    def feed(self, data: bytes) -> Iterator[Tuple[str, bytearray]]:
+        if self.finished:
+            return
+        self.buffer += data
+        buffer = self.buffer
+        position = 0
+        try:
+            while position < len(buffer) and not self.finished:
+                if self.state in ('key_string', 'string'):
+                    position, table = self._feed_string(buffer, position)
+                    if table is not None:
+                        yield table
+                    if self.state in ('key_string', 'string'):
+                        # The string continues in the next feed
+                        break
+                elif self.state == 'skip':
+                    position = self._skip(buffer, position)
+                else:
+                    position = self._feed_structural(buffer[position], position)
+        finally:
+            del buffer[:position]
+
+    def _feed_string(self, buffer: bytearray, position: int) -> Tuple[int, Optional[Tuple[str, bytearray]]]:
+        """Consume string content from position, returning the next position and any completed table"""
+
+        end = self._string_end(buffer, position)
+        stop = len(buffer) if end < 0 else end
+        # Keep a trailing escape for the next feed, it may be cut in half
+        while end < 0 and stop > position and buffer[stop - 1] == ord('\\'):
+            stop -= 1
+        segment = bytes(buffer[position:stop])
+        position = stop if end < 0 else end + 1
+        table = None
+        if self.state == 'key_string':
+            self.key += segment
+            if end >= 0:
+                self.state = 'colon'
+        else:
+            if self.body is not None:
+                self._decode(segment, final=end >= 0)
+                if end >= 0:
+                    table = self.key.decode(), self.body
+                    self.body = None
+            if end >= 0:
+                self.state = 'key'
+        return position, table
+
+    def _feed_structural(self, byte: int, position: int) -> int:
+        """Consume one byte outside of strings and skipped values, returning the next position"""
+
+        if byte in WHITESPACE:
+            pass
+        elif self.state == 'start' and byte == ord('{'):
+            self.state = 'key'
+        elif self.state == 'key' and byte == ord(','):
+            pass
+        elif self.state == 'key' and byte == ord('}'):
+            self.finished = True
+        elif self.state == 'key' and byte == ord('"'):
+            self.key = bytearray()
+            self.state = 'key_string'
+        elif self.state == 'colon' and byte == ord(':'):
+            self.state = 'value'
+        elif self.state == 'value' and byte == ord('"'):
+            if self.key.decode() in self.names:
+                self.body = bytearray()
+                self.pending = b''
+            self.state = 'string'
+        elif self.state == 'value':
+            # Not a string, so the byte is left for skip
+            self.state = 'skip'
+            return position
+        else:
+            raise ValueError(f"Malformed JSON output at {chr(byte)!r}.")
+        return position + 1
+
+    @staticmethod
+    def _string_end(buffer: bytearray, start: int) -> int:
+        """Position of the closing quote of a string whose content starts at start, or -1"""
+
+        end = buffer.find(b'"', start)
+        while end >= 0:
+            backslashes = 0
+            while end - backslashes - 1 >= start and buffer[end - backslashes - 1] == ord('\\'):
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end
+            end = buffer.find(b'"', end + 1)
+        return -1
+
+    def _decode(self, segment: bytes, final: bool):
+        if b'\\' in segment:
+            # Base64 only needs the escaped slash; escaped line breaks are dropped
+            segment = segment.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        text = self.pending + segment
+        usable = len(text) if final else len(text) - len(text) % 4
+        self.body += binascii.a2b_base64(text[:usable])
+        self.pending = text[usable:]
+
+    def _skip(self, buffer: bytearray, position: int) -> int:
+        """Step over one value of a key that is not wanted, returning the next position"""
+
+        byte = buffer[position]
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif byte == ord('\\'):
+                self.escaped = True
+            elif byte == ord('"'):
+                self.in_string = False
+        elif byte == ord('"'):
+            self.in_string = True
+        elif byte in b'{[':
+            self.depth += 1
+        elif byte in b'}]' and self.depth:
+            self.depth -= 1
+        elif (byte == ord(',') or byte == ord('}')) and not self.depth:
+            # Leave the separator for the key state
+            self.state = 'key'
+            return position
+        return position + 1
+
+
+def decode_json_stream(chunks: Iterable[bytes], record_as_arrow: bool = False):
+    """Decode a streamed JSON download into entity, attribute and record tables
+
+    Each table is decoded as soon as its base64 string has arrived. With record_as_arrow
+    the record table is returned as an Arrow table.
+    """
+
+    reader = JSONTableReader()
+    tables = {}
+    for data in chunks:
+        tables.update(_decode_tables(reader.feed(data), record_as_arrow))
+    if not reader.finished:
+        raise ValueError("Incomplete JSON response.")
+    return tables['entity'], tables['attribute'], tables['record']
+
+
+def multipart_boundary(content_type: str) -> bytes:
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise ValueError(f"No boundary in content type: {content_type}")
+    return match.group(1).encode('latin-1')
+
+
+class MultipartReader:
+    """Incremental multipart/mixed parser
+
+    Feed it the response body as it arrives; each part is returned as soon as its closing
+    boundary has been read, as a (name, body) pair with the name taken from the
+    Content-Disposition header.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.delimiter = b'\r\n--' + boundary
+        # A leading CRLF makes the first boundary look like every other one
+        self.buffer = bytearray(b'\r\n')
+        self.searched = 0
+        self.started = False
+        self.at_boundary = False
+        self.finished = False
+
+    def feed(self, data: bytes) -> Iterator[Tuple[str, bytes]]:
+        if self.finished:
+            return
+        self.buffer += data
+        while True:
+            if self.at_boundary:
+                # The closing boundary is the delimiter followed by two dashes
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer[:2] == b'--':
+                    self.finished = True
+                    return
+                self.at_boundary = False
+
+            index = self.buffer.find(self.delimiter, self.searched)
+            if index < 0:
+                # Only rescan the tail that could still hold the start of a delimiter
+                self.searched = max(0, len(self.buffer) - len(self.delimiter) + 1)
+                return
+            segment = bytes(self.buffer[:index])
+            del self.buffer[:index + len(self.delimiter)]
+            self.searched = 0
+            if self.started:
+                yield self._parse(segment)
+            self.started = True
+            self.at_boundary = True
+
+    @staticmethod
+    def _parse(segment: bytes) -> Tuple[str, bytes]:
+        if segment.startswith(b'\r\n'):
+            segment = segment[2:]
+        header_end = segment.find(b'\r\n\r\n')
+        if header_end < 0:
+            raise ValueError("Malformed multipart part: missing headers.")
+        headers = segment[:header_end].decode('latin-1')
+        match = re.search(r'name="?([^";\r\n]+)"?', headers)
+        return (match.group(1) if match else ''), segment[header_end + 4:]
+
+
+def decode_multipart_output(chunks: Iterable[bytes], content_type: str, record_as_arrow: bool = False):
+    """Decode a streamed multipart download into entity, attribute and record tables
+
+    With record_as_arrow the record table is returned as an Arrow table.
+    """
+
+    reader = MultipartReader(multipart_boundary(content_type))
+    tables = {}
+    for data in chunks:
+        tables.update(_decode_tables(reader.feed(data), record_as_arrow))
+    if not reader.finished:
+        raise ValueError("Incomplete multipart response.")
+    return tables['entity'], tables['attribute'], tables['record']
@@ -1,8 +1,38 @@
 #!/usr/bin/env python
 """Tests for `hdata` package."""
 
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 import pytest
 
+from benchmarks.datasets import make_source_frame, make_tables
+from benchmarks.mock_server import MockHyperDataServer
+from hdata import ChunkCache, Instrumentation, Source, TransformationError, functions, transform
+from hdata.accumulator import TableAccumulator
+from hdata.aio import AsyncTransport, apply_transformation_async, transform_async
+from hdata.chunking import ChunkSizer, rebatch
+from hdata.force_validation import canonical_uuids, valid_record_values, validate_output
+from hdata.functions import download, pooled_transport, send
+from hdata.models import Output, encode_chunk
+from hdata.pool import ordered_map
+from hdata.transport import RetryPolicy, Transport, set_default_transport
+from hdata.wire import decode_json_stream, decode_multipart_output, to_parquet_bytes
 
 
 @pytest.fixture
@@ -20,3 +50,968 @@ def test_content(response):
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
     del response
+
+
+def test_ordered_map_preserves_order_and_bounds_in_flight():
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def work(x):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01 * (5 - x % 5))
+        with lock:
+            in_flight[0] -= 1
+        return x * 2
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(ordered_map(work, range(20), executor, 3))
+
+    assert results == [x * 2 for x in range(20)]
+    assert in_flight[1] <= 3
+
+
+def test_apply_transformation_concurrent_matches_serial(monkeypatch):
+    def fake_transform_chunk(auth_token, transformation_key, chunk, job_uuid, index=0, *args):
+        entity = pd.DataFrame({'entity_uuid': [chunk], 'entity_name': [chunk], 'entity_description': ['']})
+        attribute = pd.DataFrame({'attribute_uuid': [chunk], 'attribute_name': [chunk], 'attribute_description': ['']})
+        record = pd.DataFrame({'datetime': ['2024'], 'entity_uuid': [chunk], 'attribute_uuid': [chunk],
+                               'record_value': [index]})
+        return entity, attribute, record
+
+    monkeypatch.setattr(functions, 'transform_chunk', fake_transform_chunk)
+    chunks = [f"chunk-{i}" for i in range(10)]
+    source = SimpleNamespace(transformation_key='key', iter_encoded_chunks=lambda *args: iter(chunks), chunk_sizer=None)
+
+    serial = functions.apply_transformation(source, 'token', 'job')
+    concurrent = functions.apply_transformation(source, 'token', 'job', max_workers=4)
+
+    for left, right in zip(serial, concurrent):
+        pd.testing.assert_frame_equal(left, right)
+    assert list(concurrent[2]['record_value']) == list(range(10))
+
+
+def test_transport_retries_with_backoff_and_retry_after():
+    statuses = [503, 429, 200]
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            status = statuses[len(calls)]
+            calls.append(status)
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '7')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    sleeps = []
+    transport = Transport(f"http://127.0.0.1:{server.server_port}", retry=RetryPolicy(total=3, backoff_factor=2))
+    transport.sleep = sleeps.append
+    try:
+        response = transport.post('/transform', data='{}')
+    finally:
+        transport.close()
+        server.shutdown()
+
+    assert response.status_code == 200
+    assert calls == [503, 429, 200]
+    assert 1 <= sleeps[0] <= 2
+    assert sleeps[1] == 7
+
+
+def test_retry_policy_backoff_is_capped():
+    policy = RetryPolicy(backoff_factor=1, backoff_max=10, jitter=0)
+    assert [policy.delay(attempt) for attempt in range(6)] == [1, 2, 4, 8, 10, 10]
+
+
+def _decode_chunk(encoded):
+    with zipfile.ZipFile(io.BytesIO(base64.b64decode(encoded))) as zipf:
+        return pd.read_parquet(io.BytesIO(zipf.read('source.parquet')))
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.parquet'])
+def test_source_streams_files_in_chunks(tmp_path, extension):
+    frame = pd.DataFrame({'name': [f"row-{i}" for i in range(25)], 'value': range(25)})
+    path = str(tmp_path / f"data{extension}")
+    if extension == '.csv':
+        frame.to_csv(path, index=False)
+    else:
+        frame.to_parquet(path, index=False)
+
+    source = Source('key', path, max_rows_per_chunk=10)
+    assert source._data_frame is None
+
+    chunks = [_decode_chunk(encoded) for encoded in source.iter_encoded_chunks()]
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert source._data_frame is None
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), frame, check_dtype=False)
+    assert len(source.zipped_chunks) == 3
+
+
+def test_source_rejects_bad_input(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Source('key', str(tmp_path / 'missing.csv'))
+    (tmp_path / 'data.txt').write_text('x')
+    with pytest.raises(ValueError):
+        Source('key', str(tmp_path / 'data.txt'))
+
+
+def _raw_tables(rows=200):
+    entity_uuids = [str(uuid.uuid4()) for _ in range(10)]
+    attribute_uuids = [str(uuid.uuid4()) for _ in range(5)]
+    # Mix in non-canonical spellings that uuid.UUID accepts
+    entity_uuids[0] = entity_uuids[0].upper()
+    entity_uuids[1] = '{' + entity_uuids[1] + '}'
+    attribute_uuids[0] = 'urn:uuid:' + attribute_uuids[0]
+    attribute_uuids[1] = attribute_uuids[1].replace('-', '')
+
+    entity = pd.DataFrame({
+        'entity_uuid': entity_uuids,
+        'entity_name': [f"entity {i}" for i in range(10)],
+        'entity_description': [None] + ['description'] * 9,
+    })
+    attribute = pd.DataFrame({
+        'attribute_uuid': attribute_uuids,
+        'attribute_name': [f"Attribute {i}" for i in range(5)],
+        'attribute_description': [''] * 5,
+    })
+    record = pd.DataFrame({
+        'datetime': [f"2024-01-{1 + i // 50:02d} 00:00" for i in range(rows)],
+        'entity_uuid': [entity_uuids[i % 10] for i in range(rows)],
+        'attribute_uuid': [attribute_uuids[(i // 10) % 5] for i in range(rows)],
+        'record_value': [float(i) for i in range(rows)],
+    })
+    return entity, attribute, record
+
+
+@pytest.mark.parametrize('values', [
+    [1.5, 2.0],
+    [1, 2],
+    ['a', 'b'],
+    [b'a', b'b'],
+    [True, False],
+    [1, 'a', [1, 2]],
+])
+def test_record_value_engines_agree(values):
+    series = pd.Series(values)
+    assert valid_record_values(series, 'vectorized') == valid_record_values(series, 'python')
+
+
+def test_record_value_rejects_invalid_types():
+    for values in [[{'a': 1}], pd.Series(np.array([np.int64(1)], dtype=object)), pd.to_datetime(['2024-01-01'])]:
+        series = pd.Series(values)
+        assert valid_record_values(series, 'vectorized') is False
+        assert valid_record_values(series, 'python') is False
+
+
+def test_canonical_uuids_matches_uuid_module():
+    series = pd.Series(['A0B1C2D3-E4F5-4789-ABCD-0123456789AB', '{a0b1c2d3-e4f5-4789-abcd-0123456789ab}',
+                        'urn:uuid:a0b1c2d3-e4f5-4789-abcd-0123456789ab', 'a0b1c2d3e4f54789abcd0123456789ab'])
+    assert canonical_uuids(series).tolist() == ['a0b1c2d3-e4f5-4789-abcd-0123456789ab'] * 4
+
+    with pytest.raises(ValueError):
+        canonical_uuids(pd.Series(['not-a-uuid']))
+
+
+def test_validate_output_engines_agree():
+    tables = _raw_tables()
+    vectorized = validate_output(*[table.copy() for table in tables], engine='vectorized')
+    python = validate_output(*[table.copy() for table in tables], engine='python')
+    for left, right in zip(vectorized, python):
+        pd.testing.assert_frame_equal(left, right)
+
+
+def test_validate_output_dictionary_encodes_record_uuids():
+    entity, attribute, record = validate_output(*_raw_tables())
+
+    for column, table in [('entity_uuid', entity), ('attribute_uuid', attribute)]:
+        assert record[column].dtype == 'category'
+        assert list(record[column].cat.categories) == list(table[column])
+        np.testing.assert_array_equal(
+            table[column].to_numpy()[record[column].cat.codes], record[column].astype(str).to_numpy())
+
+
+def test_uuid_match_validation_rejects_unknown_uuids():
+    entity, attribute, record = _raw_tables()
+    entity = entity.iloc[1:]
+    with pytest.raises(ValueError, match='must exist in the entity table'):
+        validate_output(entity, attribute, record)
+
+
+@pytest.mark.parametrize('engine', ['vectorized', 'python'])
+def test_validate_output_dedupes_uuids_equal_after_canonicalization(engine):
+    entity, attribute, record = _raw_tables()
+    # The same UUIDs spelled differently under extra names
+    entity = pd.concat([entity, pd.DataFrame({'entity_uuid': [entity['entity_uuid'][2].upper()],
+                                              'entity_name': ['entity copy'], 'entity_description': ['']})],
+                       ignore_index=True)
+    attribute = pd.concat([attribute, pd.DataFrame({'attribute_uuid': [attribute['attribute_uuid'][2].upper()],
+                                                    'attribute_name': ['Attribute copy'],
+                                                    'attribute_description': ['']})], ignore_index=True)
+
+    entity, attribute, record = validate_output(entity, attribute, record, engine=engine)
+    assert len(entity) == 10 and 'entity copy' not in entity['entity_name'].tolist()
+    assert len(attribute) == 5 and 'attribute copy' not in attribute['attribute_name'].tolist()
+    assert (record['entity_uuid'].cat.codes >= 0).all()
+
+
+def _reference_query(output, entities=None, attributes=None, after_date=None, before_date=None):
+    record = output.record.astype({'entity_uuid': str, 'attribute_uuid': str})
+    mask = record['datetime'].notna()
+    if entities is not None:
+        uuids = output.entity.set_index('entity_name').loc[entities, 'entity_uuid']
+        mask &= record['entity_uuid'].isin(uuids)
+    if attributes is not None:
+        uuids = output.attribute.set_index('attribute_name').loc[attributes, 'attribute_uuid']
+        mask &= record['attribute_uuid'].isin(uuids)
+    if after_date is not None:
+        mask &= record['datetime'] > after_date
+    if before_date is not None:
+        mask &= record['datetime'] < before_date
+    return record[mask].merge(output.entity, on=['entity_uuid']).merge(output.attribute, on=['attribute_uuid'])[
+        ['datetime', 'entity_name', 'attribute_name', 'record_value']]
+
+
+def _output(rows=200):
+    return Output(*validate_output(*_raw_tables(rows)))
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'entities': ['entity 3']},
+    {'attributes': ['attribute 2']},
+    {'entities': ['entity 1', 'entity 7'], 'attributes': ['attribute 0', 'attribute 4']},
+    {'entities': ['entity 2'], 'after_date': '2024-01-01 00:00', 'before_date': '2024-01-04'},
+    {'after_date': '2024-01-02'},
+    {'before_date': '2024-01-02'},
+])
+def test_indexed_query_matches_scan(filters):
+    output = _output()
+    kwargs = {}
+    if 'entities' in filters:
+        kwargs['entity'] = filters['entities'] if len(filters['entities']) > 1 else filters['entities'][0]
+    if 'attributes' in filters:
+        kwargs['attribute'] = filters['attributes'] if len(filters['attributes']) > 1 else filters['attributes'][0]
+    for key in ['after_date', 'before_date']:
+        if key in filters:
+            kwargs[key] = filters[key]
+
+    expected = _reference_query(output, **filters).reset_index(drop=True)
+    result = output.query(**kwargs)
+    assert len(result) > 0
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_query_unknown_name_raises():
+    output = _output()
+    with pytest.raises(ValueError, match='No entity found'):
+        output.query(entity='missing')
+
+
+def test_table_accumulator_preserves_dtypes():
+    accumulator = TableAccumulator()
+    empty = pd.DataFrame({'value': pd.Series([], dtype='int64')})
+    accumulator.add(empty, empty, empty)
+    for start in range(0, 30, 10):
+        chunk = pd.DataFrame({'value': range(start, start + 10)})
+        accumulator.add(chunk, pa.Table.from_pandas(chunk, preserve_index=False), chunk)
+
+    entity, attribute, record = accumulator.result()
+    for table in [entity, attribute, record]:
+        assert table['value'].dtype == 'int64'
+        assert table['value'].tolist() == list(range(30))
+        assert isinstance(table.index, pd.RangeIndex)
+
+
+def test_chunk_cache_skips_completed_chunks(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_send(auth_token, transformation_key, chunk, job_uuid, transport=None):
+        calls.append(chunk)
+        return SimpleNamespace(status_code=200, json=lambda: {'process_uuid': chunk})
+
+    def fake_download(auth_token, transformation_key, process_uuid, *args):
+        frame = pd.DataFrame({'value': [process_uuid]})
+        return frame, frame, frame
+
+    monkeypatch.setattr(functions, 'send', fake_send)
+    monkeypatch.setattr(functions, 'download', fake_download)
+
+    cache = ChunkCache(str(tmp_path))
+    first = functions.transform_chunk('token', 'key', 'chunk-a', 'job', 0, cache=cache)
+    second = functions.transform_chunk('token', 'key', 'chunk-a', 'job', 0, cache=ChunkCache(str(tmp_path)))
+
+    assert calls == ['chunk-a']
+    pd.testing.assert_frame_equal(first[2], second[2])
+
+
+def test_chunk_cache_evicts_least_recently_used(tmp_path):
+    frame = pd.DataFrame({'value': range(100)})
+    cache = ChunkCache(str(tmp_path), max_bytes=10 ** 9)
+    for key in ['a', 'b', 'c']:
+        cache.put(key, frame, frame, frame)
+        os.utime(cache._path(key), (time.time() - 100 + len(cache._sizes), time.time() - 100 + len(cache._sizes)))
+    assert cache.get('a') is not None
+
+    cache.max_bytes = cache.size - 1
+    cache.evict()
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+
+
+def test_chunk_cache_evict_skips_entries_removed_externally(tmp_path):
+    frame = pd.DataFrame({'value': range(100)})
+    cache = ChunkCache(str(tmp_path), max_bytes=10 ** 9)
+    for key in ['a', 'b']:
+        cache.put(key, frame, frame, frame)
+    shutil.rmtree(cache._path('a'))
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache.size == 0
+    assert 'a' not in cache and 'b' not in cache
+
+
+def _multipart_body(tables, boundary=b'table-boundary'):
+    body = b'preamble'
+    for name, frame in tables.items():
+        body += b'\r\n--' + boundary + b'\r\n'
+        body += (f'Content-Disposition: attachment; name="{name}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n').encode()
+        body += to_parquet_bytes(frame, compression='zstd')
+    return body + b'\r\n--' + boundary + b'--\r\n'
+
+
+@pytest.mark.parametrize('piece', [1, 7, 4096, 10 ** 7])
+def test_multipart_output_decodes_in_pieces(piece):
+    tables = {name: pd.DataFrame({'value': [f"{name}\r\n--table-boundar{i}" for i in range(50)]})
+              for name in ['entity', 'attribute', 'record']}
+    body = _multipart_body(tables)
+    pieces = (body[i:i + piece] for i in range(0, len(body), piece))
+
+    decoded = decode_multipart_output(pieces, 'multipart/mixed; boundary="table-boundary"')
+    for frame, expected in zip(decoded, tables.values()):
+        pd.testing.assert_frame_equal(frame, expected)
+
+
+def test_binary_send_falls_back_to_json():
+    requests_made = []
+
+    class StubTransport:
+        def post(self, path, headers, data):
+            requests_made.append((headers['Content-Type'], data))
+            return SimpleNamespace(status_code=415 if len(requests_made) == 1 else 200)
+
+    chunk = encode_chunk(pd.DataFrame({'value': [1, 2, 3]}), 'binary')
+    assert isinstance(chunk, bytes) and chunk[:4] == b'PAR1'
+
+    response = send('token', 'key', chunk, 'job', StubTransport())
+    assert response.status_code == 200
+    assert [content_type for content_type, _ in requests_made] == ['application/octet-stream', 'application/json']
+    assert requests_made[0][1] is chunk
+    fallback = json.loads(requests_made[1][1])
+    assert fallback['job_uuid'] == 'job'
+    assert _decode_chunk(fallback['raw_data'])['value'].tolist() == [1, 2, 3]
+
+
+@pytest.mark.parametrize('encode_processes', [False, True])
+def test_source_encodes_chunks_on_a_pool(encode_processes):
+    frame = pd.DataFrame({'name': [f"row-{i}" for i in range(95)], 'value': range(95)})
+    serial = Source('key', frame, max_rows_per_chunk=10)
+    pooled = Source('key', frame, max_rows_per_chunk=10, encode_workers=3, encode_processes=encode_processes)
+
+    assert list(pooled.iter_encoded_chunks()) == list(serial.iter_encoded_chunks())
+    executor = pooled._encode_pool
+    assert list(pooled.iter_encoded_chunks('binary')) == list(serial.iter_encoded_chunks('binary'))
+    # One pool serves every pass over the source
+    assert pooled._encode_pool is executor
+    if encode_processes:
+        assert executor._mp_context.get_start_method() == 'spawn'
+    pooled.close()
+    assert pooled._encode_pool is None
+
+
+def test_instrumentation_records_validation_and_encoding_spans():
+    seen = []
+    instrumentation = Instrumentation(hooks=[seen.append], log_level=logging.INFO)
+
+    source = Source('key', pd.DataFrame({'value': range(25)}), max_rows_per_chunk=10)
+    encoded = list(source.iter_encoded_chunks('binary', instrumentation, source_index=0))
+    validate_output(*_raw_tables(), instrumentation=instrumentation)
+
+    summary = instrumentation.summary()
+    assert list(summary.index) == ['split', 'encode', 'validate.columns', 'validate.entity', 'validate.attribute',
+                                   'validate.record', 'validate.uuid_match']
+    assert summary.loc['encode', 'count'] == 3
+    assert summary.loc['encode', 'rows'] == 25
+    assert summary.loc['encode', 'bytes'] == sum(len(chunk) for chunk in encoded)
+    assert summary.loc['validate.record', 'rows'] == 200
+    assert len(seen) == len(instrumentation.spans) == summary['count'].sum()
+
+
+@pytest.fixture
+def mock_api():
+    with MockHyperDataServer() as server:
+        yield server
+
+
+@pytest.mark.parametrize('options', [
+    {'max_workers': 3},
+    {'wire_format': 'binary'},
+    {'max_workers': 2, 'wire_format': 'binary'},
+])
+def test_transform_against_mock_api(mock_api, options):
+    frame = make_source_frame(250, attributes=3, entities=40)
+    transport = mock_api.transport()
+
+    serial = transform([Source('key', frame, max_rows_per_chunk=60)], 'token', transport=transport)
+    result = transform([Source('key', frame, max_rows_per_chunk=60)], 'token', transport=transport, **options)
+
+    assert len(serial.record) == 750
+    for name in ['entity', 'attribute', 'record']:
+        pd.testing.assert_frame_equal(getattr(result, name), getattr(serial, name))
+    assert serial.query(entity='entity 3', attribute='attribute_1')['record_value'].tolist() == \
+        frame[frame['name'] == 'entity 3']['attribute_1'].tolist()
+
+
+def test_transform_retries_mock_api_failures(mock_api):
+    mock_api.failure_rate = 0.5
+    frame = make_source_frame(200, attributes=2, entities=20)
+    output = transform([Source('key', frame, max_rows_per_chunk=20)], 'token', transport=mock_api.transport())
+
+    assert len(output.record) == 400
+    assert mock_api.requests.count(('POST', '/transform')) > 10
+
+
+@pytest.mark.parametrize('memory_map', [True, False])
+def test_output_round_trips_through_arrow_files(tmp_path, memory_map):
+    output = _output()
+    output.save(str(tmp_path))
+
+    allocated = pa.total_allocated_bytes()
+    loaded = Output.load(str(tmp_path), memory_map=memory_map)
+    if memory_map:
+        # Only the categorical codes are copied out of the mapped files
+        assert pa.total_allocated_bytes() - allocated < 2 * len(output.record) + 4096
+
+    assert loaded.record['entity_uuid'].dtype == 'category'
+    for name in ['entity', 'attribute', 'record']:
+        pd.testing.assert_frame_equal(getattr(loaded, name), getattr(output, name), check_dtype=False)
+    pd.testing.assert_frame_equal(
+        loaded.query(entity=['entity 1', 'entity 2'], after_date='2024-01-02'),
+        output.query(entity=['entity 1', 'entity 2'], after_date='2024-01-02'), check_dtype=False)
+
+
+def test_output_saves_mixed_record_values(tmp_path):
+    output = _output()
+    values = output.record['record_value'].astype(object)
+    values[:5] = 'text'
+    values[5], values[6], values[7] = 3, True, None
+    output.record['record_value'] = values
+    output.save(str(tmp_path))
+
+    loaded = Output.load(str(tmp_path))
+    assert 'record_value_type' not in loaded.record
+    assert loaded.record['record_value'].tolist() == values.tolist()
+    assert [type(value) for value in loaded.record['record_value'][4:9]] == [str, int, bool, type(None), float]
+
+    values[8] = [1, 2]
+    output.record['record_value'] = values
+    with pytest.raises(ValueError, match="mixes list values"):
+        output.save(str(tmp_path))
+
+
+def test_describe_entities_matches_per_entity_calls():
+    output = _output()
+    entity_ids = list(output.entity['entity_uuid'][[4, 1]])
+
+    batch = output.describe_entities(entity_ids)
+    for entity_id in entity_ids:
+        single = output.describe_entity(entity_id, output.attribute, output.record)
+        profile = batch[batch['entity_uuid'] == entity_id]
+        assert sorted(zip(profile['attribute_name'], profile['record_value'])) == \
+            sorted(zip(single['attribute_name'], single['record_value']))
+    assert list(dict.fromkeys(batch['entity_uuid'])) == entity_ids
+    assert len(output.describe_entities()) == len(output.record)
+
+
+def test_describe_attributes_matches_per_attribute_calls():
+    output = _output()
+    attribute_id = output.attribute['attribute_uuid'][2]
+
+    batch = output.describe_attributes([attribute_id])
+    single = output.describe_attribute(attribute_id, output.entity, output.record)
+    assert sorted(zip(batch['entity_name'], batch['record_value'])) == \
+        sorted(zip(single['entity_name'], single['record_value']))
+
+
+def test_wide_profiles_hold_latest_values():
+    output = _output()
+    wide = output.describe_entities(wide=True)
+    assert wide.shape == (len(output.entity), len(output.attribute))
+
+    latest = output.query().sort_values('datetime', kind='stable').groupby(
+        ['entity_name', 'attribute_name'])['record_value'].last()
+    names = dict(zip(output.entity['entity_uuid'], output.entity['entity_name']))
+    for (entity_uuid, attribute_name), value in wide.stack().items():
+        assert latest[(names[entity_uuid], attribute_name)] == value
+
+    by_attribute = output.describe_attributes(wide=True)
+    assert (by_attribute.to_numpy() == wide.to_numpy().T).all()
+    with pytest.raises(ValueError):
+        output.describe_entities(['not-a-uuid'])
+
+
+def test_to_matrix_latest_and_bucketed_values():
+    output = _output()
+    matrix = output.to_matrix()
+    assert matrix.values.shape == (len(output.entity), len(output.attribute))
+    assert list(matrix.entities) == list(output.entity['entity_uuid'].astype(str))
+    assert list(matrix.attributes) == list(output.attribute['attribute_uuid'].astype(str))
+    np.testing.assert_array_equal(matrix.values, output.describe_entities(wide=True).to_numpy())
+    assert output.to_matrix() is matrix
+
+    daily = output.to_matrix(freq='D')
+    assert [str(bucket) for bucket in daily.buckets] == ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04']
+    assert daily.values.shape == (4, len(output.entity), len(output.attribute))
+    records = output.query(after_date='2024-01-02', before_date='2024-01-03')
+    entity = {name: row for row, name in enumerate(output.entity['entity_name'])}
+    attribute = {name: row for row, name in enumerate(output.attribute['attribute_name'])}
+    for row in records.itertuples():
+        assert daily.values[1, entity[row.entity_name], attribute[row.attribute_name]] == row.record_value
+    np.testing.assert_array_equal(daily.values[-1], matrix.values)
+
+    output.invalidate()
+    assert output.to_matrix() is not matrix
+
+
+def test_to_matrix_sparse_matches_dense():
+    pytest.importorskip('scipy')
+    output = _output()
+    np.testing.assert_array_equal(output.to_matrix(sparse=True).values.toarray(), output.to_matrix().values)
+    sparse = output.to_matrix(freq='D', sparse=True)
+    dense = output.to_matrix(freq='D')
+    for bucket, values in enumerate(sparse.values):
+        np.testing.assert_array_equal(values.toarray(), np.nan_to_num(dense.values[bucket]))
+
+
+def _split_outputs():
+    entity, attribute, record = _raw_tables(400)
+    extra = str(uuid.uuid4())
+    entity = pd.concat([entity, pd.DataFrame({'entity_uuid': [extra], 'entity_name': ['entity new'],
+                                              'entity_description': ['']})], ignore_index=True)
+    record = pd.concat([record, pd.DataFrame({'datetime': ['2024-01-01 00:00'], 'entity_uuid': [extra],
+                                              'attribute_uuid': [record['attribute_uuid'][0]],
+                                              'record_value': [-1.0]})], ignore_index=True)
+    first, second = record.iloc[:200], record.iloc[200:]
+    outputs = [Output(*validate_output(entity[entity['entity_uuid'].isin(part['entity_uuid'])].copy(),
+                                       attribute.copy(), part.copy()))
+               for part in (first, second)]
+    return outputs, Output(*validate_output(entity.copy(), attribute.copy(), record.copy()))
+
+
+def test_append_matches_full_validation_and_updates_index():
+    (output, delta), full = _split_outputs()
+    output.query(entity='entity 0')
+    index = output.index
+    profile = output.describe_entities(wide=True)
+    assert output.append(delta) is output
+    assert output.index is index
+    assert len(output.entity) == 11 and len(output.record) == len(full.record)
+    assert output.record['entity_uuid'].cat.categories.tolist() == output.entity['entity_uuid'].tolist()
+
+    rebuilt = type(output)(output.entity, output.attribute, output.record)
+    for name in ['order', 'sorted_datetimes', 'record_entity', 'record_attribute']:
+        np.testing.assert_array_equal(getattr(index, name), getattr(rebuilt.index, name))
+    for name in ['entity_postings', 'attribute_postings']:
+        np.testing.assert_array_equal(getattr(index, name).positions, getattr(rebuilt.index, name).positions)
+        np.testing.assert_array_equal(getattr(index, name).offsets, getattr(rebuilt.index, name).offsets)
+
+    for kwargs in [{'entity': 'entity new'}, {'entity': 'entity 3', 'after_date': '2024-01-03'},
+                   {'attribute': 'attribute 2', 'before_date': '2024-01-06'}]:
+        result = output.query(**kwargs).sort_values(['datetime', 'entity_name', 'attribute_name'])
+        expected = full.query(**kwargs).sort_values(['datetime', 'entity_name', 'attribute_name'])
+        assert result.reset_index(drop=True).equals(expected.reset_index(drop=True))
+    assert output.describe_entities(wide=True) is not profile
+
+
+def test_append_rejects_existing_keys_and_name_collisions():
+    (output, delta), _ = _split_outputs()
+    with pytest.raises(Exception, match="duplicate combinations"):
+        output.append(type(output)(output.entity, output.attribute, output.record.iloc[:3]))
+
+    entity = delta.entity.copy()
+    entity.loc[0, 'entity_name'] = 'renamed'
+    with pytest.raises(ValueError, match="different entity_name"):
+        output.append(type(output)(entity, delta.attribute, delta.record))
+
+    attribute = delta.attribute.copy()
+    attribute['attribute_uuid'] = [str(uuid.uuid4()) for _ in range(len(attribute))]
+    with pytest.raises(ValueError, match="different attribute_uuid"):
+        output.append(type(output)(delta.entity, attribute, delta.record))
+    assert len(output.record) == 200
+
+
+def test_append_cost_does_not_scale_with_stored_records(monkeypatch):
+    entity, attribute, record = make_tables(300_100)
+    stored, new = record.iloc[:-100], record.iloc[-100:]
+    start = time.perf_counter()
+    output = Output(*validate_output(entity.copy(), attribute.copy(), stored.copy()))
+    validate_seconds = time.perf_counter() - start
+    output._record_keys()
+    delta = Output(*validate_output(entity[entity['entity_uuid'].isin(new['entity_uuid'])].copy(),
+                                    attribute[attribute['attribute_uuid'].isin(new['attribute_uuid'])].copy(),
+                                    new.copy()))
+
+    hashed = []
+    hash_keys = Output._hash_keys
+    monkeypatch.setattr(Output, '_hash_keys', staticmethod(lambda table: hashed.append(len(table)) or hash_keys(table)))
+    start = time.perf_counter()
+    output.append(delta)
+    append_seconds = time.perf_counter() - start
+    with pytest.raises(Exception, match="duplicate combinations"):
+        output.append(delta)
+
+    # Only the new records are hashed, also when a hash matches stored records
+    assert hashed == [100, 100]
+    assert append_seconds < validate_seconds / 2
+    assert len(output.record) == len(record)
+
+
+@pytest.mark.parametrize('kind', ['frame', 'parquet', 'csv'])
+def test_target_chunk_bytes_sizes_chunks_by_payload(tmp_path, kind):
+    rng = np.random.default_rng(0)
+    narrow = pd.DataFrame({'value': rng.random(20000)})
+    wide = pd.DataFrame(rng.random((20000, 20)), columns=[f"c{i}" for i in range(20)])
+    sizes = {}
+    for name, frame in [('narrow', narrow), ('wide', wide)]:
+        data = frame
+        if kind != 'frame':
+            data = str(tmp_path / f"{name}.{kind}")
+            frame.to_parquet(data) if kind == 'parquet' else frame.to_csv(data, index=False)
+        source = Source('key', data, target_chunk_bytes=64 * 1024)
+        chunks = list(source.iter_chunks(wire_format='binary'))
+        assert np.allclose(pd.concat(chunks).to_numpy(), frame.to_numpy())
+        encoded = list(source.iter_encoded_chunks('binary'))
+        assert all(len(chunk) < 2 * 64 * 1024 for chunk in encoded)
+        sizes[name] = len(chunks[0])
+    assert sizes['narrow'] > 5 * sizes['wide']
+
+
+def test_target_chunk_bytes_applies_to_cached_chunks():
+    frame = pd.DataFrame(np.random.default_rng(0).random((20000, 20)), columns=[f"c{i}" for i in range(20)])
+    source = Source('key', frame, target_chunk_bytes=64 * 1024)
+    zipped = source.zipped_chunks
+    assert len(zipped) > 1
+    assert all(len(chunk) < 2 * 64 * 1024 for chunk in zipped)
+    assert list(source.iter_encoded_chunks('json')) == zipped
+    pd.testing.assert_frame_equal(pd.concat(source.data_chunks), frame)
+
+
+def test_chunk_sizer_calibrates_per_source():
+    rng = np.random.default_rng(0)
+    narrow = pd.DataFrame({'value': rng.random(20000)})
+    wide = pd.DataFrame(rng.random((20000, 20)), columns=[f"c{i}" for i in range(20)])
+    sizer = ChunkSizer(target_bytes=64 * 1024)
+    sources = [Source('key', frame, chunk_sizer=sizer) for frame in (narrow, wide)]
+
+    for source in sources:
+        encoded = list(source.iter_encoded_chunks('binary'))
+        assert all(len(chunk) < 2 * 64 * 1024 for chunk in encoded)
+    assert sources[0].chunk_sizer.bytes_per_row * 5 < sources[1].chunk_sizer.bytes_per_row
+    assert sizer.bytes_per_row is None
+
+
+def test_chunk_sizer_adapts_to_latency():
+    sizer = ChunkSizer(target_bytes=1024 ** 2, adaptive=True, target_seconds=10.0)
+    sizer.observe_encoded(100 * 1000, 1000)
+    assert sizer.rows() == 1024 ** 2 // 100
+    sizer.observe_latency(1024 ** 2, 40.0)
+    assert sizer.target_bytes == 1024 ** 2 // 4
+    sizer.observe_latency(sizer.target_bytes, 1.0)
+    assert sizer.target_bytes == 1024 ** 2 * 3 // 8
+    ChunkSizer(adaptive=False).observe_latency(1024 ** 2, 40.0)
+
+    sizes = iter([3, 5, 2])
+    frame = pd.DataFrame({'a': range(12)})
+    chunks = list(rebatch([frame.iloc[:4], frame.iloc[4:8], frame.iloc[8:]], lambda: next(sizes, 100)))
+    assert [len(chunk) for chunk in chunks] == [3, 5, 2, 2]
+    assert pd.concat(chunks)['a'].tolist() == list(range(12))
+
+
+@pytest.mark.parametrize('wire_format', ['json', 'binary'])
+def test_transform_async_matches_transform(mock_api, wire_format):
+    pytest.importorskip('httpx')
+
+    frames = [make_source_frame(150, attributes=3, entities=30), make_source_frame(90, attributes=2, entities=10)]
+    frames[1]['name'] = 'other ' + frames[1]['name']
+    expected = transform([Source('key', frame, max_rows_per_chunk=40) for frame in frames], 'token',
+                         transport=mock_api.transport(), wire_format=wire_format)
+
+    async def run():
+        async with AsyncTransport(mock_api.url) as transport:
+            return await transform_async([Source('key', frame, max_rows_per_chunk=40) for frame in frames], 'token',
+                                         max_workers=3, transport=transport, wire_format=wire_format)
+
+    result = asyncio.run(run())
+    for name in ['entity', 'attribute', 'record']:
+        pd.testing.assert_frame_equal(getattr(result, name), getattr(expected, name))
+
+
+def test_transform_async_shares_limit_and_cancels(mock_api):
+    pytest.importorskip('httpx')
+
+    mock_api.transform_latency = 0.05
+    frame = make_source_frame(100, attributes=2, entities=10)
+    instrumentation = Instrumentation()
+    in_flight = []
+
+    async def run():
+        limit = asyncio.Semaphore(2)
+        async with AsyncTransport(mock_api.url) as transport:
+            original = transport.post
+
+            async def post(*args, **kwargs):
+                in_flight.append(2 - limit._value)
+                return await original(*args, **kwargs)
+
+            transport.post = post
+            jobs = [apply_transformation_async(Source('key', frame, max_rows_per_chunk=10), 'token', 'job',
+                                               max_workers=4, transport=transport, limit=limit)
+                    for _ in range(2)]
+            results = await asyncio.gather(*jobs)
+
+            mock_api.transform_latency = 1.0
+            task = asyncio.create_task(apply_transformation_async(
+                Source('key', frame, max_rows_per_chunk=10), 'token', 'job', max_workers=4, transport=transport,
+                instrumentation=instrumentation))
+            await asyncio.sleep(0.2)
+            start = time.perf_counter()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return results, time.perf_counter() - start
+
+    results, cancel_seconds = asyncio.run(run())
+    assert [len(record) for _, _, record in results] == [200, 200]
+    assert max(in_flight) == 2
+    assert cancel_seconds < 0.5
+    assert any(span.stage == 'upload' and span.error for span in instrumentation.spans)
+
+
+@pytest.mark.parametrize('piece', [1, 5, 1000, 10 ** 7])
+def test_json_output_decodes_in_pieces(piece):
+    tables = {name: pd.DataFrame({'value': [f"{name} {i}" for i in range(50)]})
+              for name in ['entity', 'attribute', 'record']}
+    output = {'status': {'note': ['"}', None]}, 'rows': 50}
+    output.update({name: base64.b64encode(to_parquet_bytes(table)).decode() for name, table in tables.items()})
+    # Some encoders escape forward slashes
+    body = json.dumps(output, indent=1).replace('/', '\\/').encode()
+    pieces = (body[i:i + piece] for i in range(0, len(body), piece))
+
+    decoded = decode_json_stream(pieces)
+    for frame, expected in zip(decoded, tables.values()):
+        pd.testing.assert_frame_equal(frame, expected)
+
+    with pytest.raises(ValueError, match="Incomplete JSON"):
+        decode_json_stream([body[:-10]])
+
+
+def test_download_streams_record_as_arrow(mock_api):
+    frame = pd.DataFrame({'name': ['a', 'b'], 'date': ['2024-01-01', '2024-01-02'], 'x': [1.0, 2.0]})
+    transport = mock_api.transport()
+    accumulator = TableAccumulator()
+    for wire_format in ['json', 'binary']:
+        process_uuid = send('token', 'key', encode_chunk(frame, wire_format), 'job', transport).json()['process_uuid']
+        tables = download('token', 'key', process_uuid, transport, wire_format, record_as_arrow=True)
+        assert isinstance(tables[0], pd.DataFrame) and isinstance(tables[2], pa.Table)
+        accumulator.add(*tables)
+    record = accumulator.result()[2]
+    assert record['record_value'].tolist() == [1.0, 2.0, 1.0, 2.0]
+
+
+def test_transform_runs_sources_in_parallel_under_one_budget(mock_api, monkeypatch):
+    frames = [make_source_frame(60, attributes=2, entities=6) for _ in range(4)]
+    for i, frame in enumerate(frames):
+        frame['name'] = f"source {i} " + frame['name']
+
+    def sources():
+        return [Source('key', frame, max_rows_per_chunk=10) for frame in frames]
+
+    expected = transform(sources(), 'token', transport=mock_api.transport(), max_sources=1)
+
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    send = functions.send
+
+    def counting_send(*args):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        try:
+            return send(*args)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    monkeypatch.setattr(functions, 'send', counting_send)
+    mock_api.transform_latency = 0.02
+    output = transform(sources(), 'token', max_workers=3, transport=mock_api.transport())
+
+    for name in ['entity', 'attribute', 'record']:
+        pd.testing.assert_frame_equal(getattr(output, name), getattr(expected, name))
+    assert in_flight[1] == 3
+    assert [(status.state, status.chunks, status.rows) for status in output.source_status] == \
+        [('succeeded', 6, 120)] * 4
+
+
+def test_transform_bounds_encoded_chunks_across_sources(mock_api, monkeypatch):
+    frames = [make_source_frame(40, attributes=2, entities=4) for _ in range(20)]
+    for i, frame in enumerate(frames):
+        frame['name'] = f"source {i} " + frame['name']
+
+    lock = threading.Lock()
+    held = [0, 0]
+    iter_encoded_chunks = Source.iter_encoded_chunks
+    transform_chunk = functions.transform_chunk
+
+    def counting_chunks(self, *args):
+        for chunk in iter_encoded_chunks(self, *args):
+            with lock:
+                held[0] += 1
+                held[1] = max(held)
+            yield chunk
+
+    def counting_transform_chunk(*args):
+        try:
+            return transform_chunk(*args)
+        finally:
+            with lock:
+                held[0] -= 1
+
+    monkeypatch.setattr(Source, 'iter_encoded_chunks', counting_chunks)
+    monkeypatch.setattr(functions, 'transform_chunk', counting_transform_chunk)
+    mock_api.transform_latency = 0.01
+    output = transform([Source('key', frame, max_rows_per_chunk=10) for frame in frames], 'token', max_workers=2,
+                       transport=mock_api.transport(), max_sources=20)
+    assert len(output.record) == 20 * 80
+    assert held[1] == 2
+
+
+def test_apply_transformation_raises_on_failed_chunk(mock_api, monkeypatch):
+    send = functions.send
+
+    def failing_send(auth_token, transformation_key, chunk, *args):
+        if failing_send.calls == 2:
+            return SimpleNamespace(status_code=400, content=b'bad chunk')
+        failing_send.calls += 1
+        return send(auth_token, transformation_key, chunk, *args)
+
+    failing_send.calls = 0
+    monkeypatch.setattr(functions, 'send', failing_send)
+    source = Source('key', make_source_frame(40, attributes=2, entities=4), max_rows_per_chunk=10)
+    with pytest.raises(TransformationError, match="Chunk 2 failed") as error:
+        functions.apply_transformation(source, 'token', 'job', transport=mock_api.transport())
+    assert error.value.output is None
+    assert error.value.source_status[0].state == 'failed'
+
+
+def test_transform_isolates_and_retries_failed_sources(mock_api, monkeypatch):
+    frames = [make_source_frame(40, attributes=2, entities=4) for _ in range(3)]
+    for i, frame in enumerate(frames):
+        frame['name'] = f"source {i} " + frame['name']
+    send = functions.send
+    calls = []
+
+    def flaky_send(auth_token, transformation_key, *args):
+        calls.append(transformation_key)
+        # 'flaky' fails one chunk once; 'broken' fails every chunk
+        if (transformation_key == 'flaky' and calls.count('flaky') == 3) or transformation_key == 'broken':
+            return SimpleNamespace(status_code=400, content=b'bad chunk')
+        return send(auth_token, transformation_key, *args)
+
+    monkeypatch.setattr(functions, 'send', flaky_send)
+    transport = mock_api.transport()
+
+    def sources():
+        return [Source(key, frame, max_rows_per_chunk=10) for key, frame in zip(['ok', 'flaky', 'broken'], frames)]
+
+    with pytest.raises(TransformationError, match="1 of 3 sources failed") as error:
+        transform(sources(), 'token', max_workers=2, transport=transport)
+    statuses = error.value.source_status
+    assert [(status.state, status.attempts) for status in statuses] == \
+        [('succeeded', 1), ('succeeded', 2), ('failed', 2)]
+    assert statuses[2].error == "Chunk 0 failed."
+    assert len(error.value.output.record) == 2 * 80
+    assert set(error.value.output.entity['entity_name'].str[:8]) == {'source 0', 'source 1'}
+
+    calls.clear()
+    output = transform(sources(), 'token', transport=transport, source_retries=0, allow_partial=True)
+    assert [status.state for status in output.source_status] == ['succeeded', 'failed', 'failed']
+    assert len(output.record) == 80
+
+    # A failed transform leaves append_to unchanged
+    calls.clear()
+    with pytest.raises(TransformationError):
+        transform(sources()[1:], 'token', transport=transport, append_to=output)
+    assert len(output.record) == 80
+    assert set(output.entity['entity_name'].str[:8]) == {'source 0'}
+
+
+def test_failed_transform_resumes_under_its_job_uuid(mock_api, monkeypatch, tmp_path):
+    frames = [make_source_frame(40, attributes=2, entities=4) for _ in range(2)]
+    frames[1]['name'] = 'other ' + frames[1]['name']
+    send = functions.send
+    sent = []
+    broken = [True]
+
+    def recording_send(auth_token, transformation_key, chunk, job_uuid, *args):
+        sent.append((transformation_key, job_uuid))
+        if transformation_key == 'broken' and broken[0]:
+            return SimpleNamespace(status_code=400, content=b'bad chunk')
+        return send(auth_token, transformation_key, chunk, job_uuid, *args)
+
+    def sources():
+        return [Source(key, frame, max_rows_per_chunk=10) for key, frame in zip(['ok', 'broken'], frames)]
+
+    monkeypatch.setattr(functions, 'send', recording_send)
+    cache = ChunkCache(str(tmp_path))
+    with pytest.raises(TransformationError) as error:
+        transform(sources(), 'token', transport=mock_api.transport(), cache=cache, source_retries=0)
+    job_uuid = error.value.job_uuid
+    assert job_uuid is not None and error.value.output.job_uuid == job_uuid
+    assert {job for _, job in sent} == {job_uuid}
+
+    sent.clear()
+    broken[0] = False
+    output = transform(sources(), 'token', transport=mock_api.transport(), cache=cache, job_uuid=job_uuid)
+    assert output.job_uuid == job_uuid
+    assert sent == [('broken', job_uuid)] * 4
+    assert len(output.record) == 2 * 80
+
+
+def test_pooled_transport_sizes_pool_to_max_workers(caplog):
+    default = Transport(pool_maxsize=2)
+    set_default_transport(default)
+    try:
+        assert pooled_transport(None, 20) is default
+        assert default.pool_maxsize == 20
+        assert default.session.get_adapter('https://api.hyperdata.so')._pool_maxsize == 20
+    finally:
+        set_default_transport(None)
+
+    custom = Transport(pool_maxsize=4)
+    with caplog.at_level('WARNING', logger='hdata'):
+        assert pooled_transport(custom, 8) is custom
+    assert custom.pool_maxsize == 4
+    assert "pool_maxsize=4" in caplog.text